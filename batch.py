@@ -0,0 +1,187 @@
+"""
+This module runs the solver independently of the Processing frame
+loop, either to completion (headless mode) or in time-budgeted
+batches of generations per frame.
+
+Run it as a script to run the solver on a server without a display
+or Processing, on the NumPy raster backend under CPython 2.7:
+
+    python2.7 batch.py [data folder]
+
+"""
+import os
+import sys
+import time
+import utils
+
+
+report_interval = 60 # Seconds between throughput reports in headless mode
+
+
+class Throughput(object):
+    '''Measure how many generations and evaluations the solver
+    completes per second.
+    '''
+    def __init__(self, ga):
+        self.ga = ga
+        self.timer = utils.Timer()
+        self.start_generation = ga.generation_number()
+        self.start_evaluations = ga.evaluation_count()
+        
+    @property
+    def generations(self):
+        return self.ga.generation_number() - self.start_generation
+    
+    @property
+    def evaluations(self):
+        return self.ga.evaluation_count() - self.start_evaluations
+        
+    def __str__(self):
+        elapsed = max(self.timer.elapsed(), 1e-9)
+        return "{} generations in {} ({:.2f} generations/sec, {:.1f} evaluations/sec)".format(
+            self.generations, utils.time_str(elapsed), self.generations / elapsed, self.evaluations / elapsed)
+
+
+def run_for(ga, step, seconds):
+    '''Call step() to evolve generations until the time budget is 
+    spent or the search is finished. At least one generation is
+    evolved. Return the number of generations evolved.
+    '''
+    timer = utils.Timer()
+    count = 0
+    while not ga.finished():
+        step()
+        count += 1
+        if timer.elapsed() >= seconds:
+            break
+    return count
+
+
+def run_to_completion(ga, step):
+    '''Call step() to evolve generations until the search is finished,
+    printing the throughput every report_interval seconds. Return the
+    Throughput of the whole run.
+    '''
+    throughput = Throughput(ga)
+    lastreport = time.time()
+    while not ga.finished():
+        step()
+        if time.time() - lastreport >= report_interval:
+            print("Throughput: {}".format(throughput))
+            lastreport = time.time()
+    print("Throughput: {}".format(throughput))
+    return throughput
+
+
+def run_headless(data_path=None):
+    '''Run the solver to completion on the raster backend, without
+    Processing or a display. Settings are read from settings.py and
+    results are saved to the run folder, as in the sketch. Return the
+    Throughput of the whole run.
+    '''
+    import raster
+    import drawing
+    import islands
+    import genetic as ga
+    import cell_fitness
+    import incremental
+    import image_comparator as ic
+    import settings as config
+    try:
+        import adminsettings
+        adminsettings.override(config)
+    except ImportError:
+        pass
+    if config.app.testmode:
+        raise ValueError("app.testmode shows random drawings in the sketch window. Set it to False to run headless.")
+    if os.path.isfile(os.path.join(sketch_path(), "fitness.py")):
+        print("WARNING: Ignoring fitness.py, which is only used by the sketch.")
+    config.version = sketch_version()
+    width = config.width if hasattr(config, "width") else 400
+    height = config.height if hasattr(config, "height") else 400
+    sketch = raster.Sketch(width, height, data_path or os.path.join(sketch_path(), "data"))
+    utils.configure(drawing, config.drawing)
+    utils.configure(ga, config.ga)
+    utils.configure(ic, config.ic)
+    if hasattr(config, "islands"):
+        utils.configure(islands, config.islands)
+    utils.profiler.enabled = getattr(config.app, "profile", False)
+    drawing.initialize()
+    resume_run = getattr(config.app, "resume_run", None)
+    checkpoint = utils.load_checkpoint(sketch, resume_run) if resume_run is not None else None
+    w, h = ic.evaluation_size(width, height)
+
+    def create_phenotype(chromosome):
+        return drawing.render_offscreen(sketch, chromosome, w, h)
+
+    def create_phenotypes(chromosomes):
+        return drawing.render_atlas(sketch, chromosomes, w, h)
+
+    def compute_fitness(phenotype):
+        return ic.compare(sketch, phenotype)
+
+    def compute_bounded_fitness(phenotype, bound):
+        return ic.compare(sketch, phenotype, bound=bound)
+
+    def compute_coarse_fitness(chromosome, strictness):
+        cw, ch = ic.evaluation_size(width, height, strictness)
+        return ic.compare(sketch, drawing.render_offscreen(sketch, chromosome, cw, ch), strictness)
+
+    def genome_key(chromosome):
+        return drawing.genome_key(sketch, chromosome)
+
+    cell_table = cell_fitness.create(sketch, w, h)
+    evaluator = None if cell_table else incremental.create(sketch, w, h)
+    if cell_table is not None:
+        ga.initialize(drawing.num_params(), lambda chromosome: chromosome, cell_table.score, genome_key, checkpoint=checkpoint)
+    elif evaluator is not None:
+        ga.initialize(drawing.num_params(), evaluator.render, evaluator.score, genome_key, coarse_func=compute_coarse_fitness,
+                      checkpoint=checkpoint, delta_func=evaluator.update)
+    else:
+        ga.initialize(drawing.num_params(), create_phenotype, compute_fitness, genome_key, coarse_func=compute_coarse_fitness,
+                      bounded_func=compute_bounded_fitness, checkpoint=checkpoint,
+                      batch_func=create_phenotypes if drawing.config_atlas_rendering else None)
+    islands.join(sketch, ga)
+    if checkpoint:
+        print("Resuming run {} at generation {}".format(utils.run_number(sketch), ga.generation_number()))
+    else:
+        print("Starting run {}".format(utils.run_number(sketch)))
+        utils.create_report(sketch, config, drawing, ga, ic)
+        utils.copy_input_images(sketch)
+
+    def step():
+        utils.autosave(sketch, ga, drawing, config.app.autosave_fittest_only)
+        ga.evolve()
+        interval = getattr(config.app, "checkpoint_interval", 0)
+        if interval and ga.generation_number() % interval == 0:
+            utils.save_checkpoint(sketch, ga)
+        utils.profiler.write_generation(os.path.join(utils.run_dir_path(sketch), "timings.csv"), ga.generation_number())
+
+    print("Running headless...")
+    throughput = run_to_completion(ga, step)
+    utils.autosave(sketch, ga, drawing, config.app.autosave_fittest_only) # The last generation's fittest
+    utils.flush_autosave()
+    utils.write_strings_to_file(os.path.join(utils.run_dir_path(sketch), "throughput.txt"), [str(throughput)])
+    for stats in (cell_table, evaluator):
+        if stats is not None:
+            print(stats)
+    islands.leave()
+    print("All output was saved to <{}>.".format(utils.run_dir_path(sketch)))
+    return throughput
+
+
+def sketch_path():
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def sketch_version():
+    '''Return the version that the sketch sets, for the run report.'''
+    with open(os.path.join(sketch_path(), "Evolutionary_Collage.pyde")) as f:
+        for line in f:
+            if line.startswith("config.version"):
+                return line.split("=", 1)[1].strip().strip('"')
+    return "unknown"
+
+
+if __name__ == "__main__":
+    run_headless(sys.argv[1] if len(sys.argv) > 1 else None)
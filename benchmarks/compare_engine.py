@@ -0,0 +1,86 @@
+"""
+Micro-benchmark for the bulk scoring engine in image_comparator.
+
+Scores synthetic preprocessed images against synthetic samples at
+every strictness level, once with the per-pixel loop that compare()
+used before the engine was introduced and once with ScoringEngine,
+and prints evaluations per second for both.
+
+Run from the sketch folder with Jython or Python 2.7:
+
+    python benchmarks/compare_engine.py [num_samples] [seconds_per_case] [binary]
+
+With 16 or more samples (or more than two binary samples) the
+engine uses its per-pixel sample index. The synthetic pixels are
+whole numbers, as in gray and binary mode, so the indexed scores
+must equal the unindexed ones exactly.
+
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import image_comparator as ic
+
+
+def legacy_score(samples, imgpixels):
+    '''The scoring loop used by compare() before ScoringEngine.'''
+    overall_score = 0.0
+    for samplepixels in samples:
+        score = 0.0
+        for i, p in enumerate(imgpixels):
+            score += 1.0 - (abs(samplepixels[i] - imgpixels[i]) / 255.0)
+        score /= len(imgpixels)
+        overall_score += score
+    overall_score /= len(samples)
+    return overall_score
+
+
+def random_pixels(rng, n, binary=False):
+    if binary:
+        return [float(rng.choice((0, 255))) for i in range(n)]
+    return [float(rng.randint(0, 255)) for i in range(n)]
+
+
+def evaluations_per_sec(func, images, seconds):
+    count = 0
+    start = time.time()
+    while True:
+        for img in images:
+            func(img)
+        count += len(images)
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def run(num_samples=3, seconds=1.0, binary=False, seed=1):
+    rng = random.Random(seed)
+    print("Samples: {} ({})".format(num_samples, "binary" if binary else "gray"))
+    print("{:>10} {:>8} {:>14} {:>14} {:>8}".format("strictness", "pixels", "legacy eval/s", "engine eval/s", "speedup"))
+    for strictness, size in enumerate(ic.comparison_sizes, 1):
+        n = size * size
+        samples = [random_pixels(rng, n, binary) for s in range(num_samples)]
+        images = [random_pixels(rng, n) for i in range(8)]
+        engine = ic.ScoringEngine(samples, True) # Whole-number pixels, so the index applies
+        bulk_engine = ic.ScoringEngine(samples, True)
+        bulk_engine.index = None
+        for img in images:
+            if abs(engine.score(img) - legacy_score(samples, img)) > 1e-9:
+                raise AssertionError("Engine and legacy scores differ at strictness {}".format(strictness))
+            if engine.score(img) != bulk_engine.score(img):
+                raise AssertionError("Indexed and unindexed scores differ at strictness {}".format(strictness))
+        legacy = evaluations_per_sec(lambda img: legacy_score(samples, img), images, seconds)
+        bulk = evaluations_per_sec(lambda img: engine.score(engine.candidate(img)), images, seconds) # Converted as compare() does
+        print("{:>10} {:>8} {:>14.1f} {:>14.1f} {:>7.1f}x".format(strictness, n, legacy, bulk, bulk / legacy))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    num_samples = int(args[0]) if len(args) > 0 else 3
+    seconds = float(args[1]) if len(args) > 1 else 1.0
+    binary = len(args) > 2 and args[2] == "binary"
+    run(num_samples, seconds, binary)
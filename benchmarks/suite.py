@@ -0,0 +1,237 @@
+"""
+Deterministic benchmark suite for rendering, comparing and evolving.
+
+Builds a fixed set of seeded synthetic parts and comparator samples
+and times:
+
+  - drawing.render_offscreen() for GridLayout and PointLayout at
+    several part counts,
+  - image_comparator.load_samples() for each preprocess mode,
+    with an empty sample cache and again from the cache,
+  - image_comparator.compare() at strictness 1-7 for each
+    preprocess mode,
+  - a number of full generations of genetic.Evolver.
+
+Every case does the same work on every run, and reports a checksum
+of its results next to its timings so that a change in behaviour is
+not mistaken for a change in speed. The results are printed, and
+written as JSON if an output path is given, so that runs can be
+compared across versions.
+
+Outside of Processing the sketch is replaced by the NumPy raster
+backend in raster.py. Run from the sketch folder with CPython 2.7
+and NumPy:
+
+    python2.7 benchmarks/suite.py [output.json] [generations] [repeats]
+
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import raster
+import drawing
+import genetic
+import image_comparator as ic
+import utils
+
+
+render_layouts = ["GridLayout", "PointLayout"]
+render_part_counts = [9, 25, 49]
+render_count = 20 # Drawings rendered per case
+compare_modes = ["gray", "binary", "color", "hue"]
+compare_count = 20 # Images compared per case
+num_parts = 8
+num_samples = 3
+part_size = 240 # Longest side of the synthetic parts, which are drawn for hi-res output
+sample_size = 400
+
+
+def synthetic_part(rng, size):
+    '''Return an opaque blob of random rectangles on a transparent background.'''
+    w = rng.randint(size / 2, size)
+    h = rng.randint(size / 2, size)
+    img = raster.Graphics(w, h)
+    img.beginDraw()
+    img.clear()
+    shade = rng.randint(0, 160)
+    img.fill(shade)
+    for i in range(rng.randint(2, 5)):
+        img.rect(rng.randint(0, w / 2), rng.randint(0, h / 2), rng.randint(w / 4, w / 2), rng.randint(h / 4, h / 2))
+    img.endDraw()
+    return img.get()
+
+
+def synthetic_sample(rng, size):
+    '''Return a figure-ground diagram of random coloured rectangles on white.'''
+    img = raster.Graphics(size, size)
+    img.beginDraw()
+    img.background(255)
+    for i in range(rng.randint(8, 16)):
+        img.fill(rng.randint(0, 120), rng.randint(0, 120), rng.randint(0, 120))
+        img.rect(rng.randint(0, size), rng.randint(0, size), rng.randint(size / 10, size / 3), rng.randint(size / 10, size / 3))
+    img.endDraw()
+    return img.get()
+
+
+def create_sketch(seed):
+    '''Return a raster sketch with a data folder of synthetic parts
+    and comparator samples saved as PNG files.'''
+    data_path = tempfile.mkdtemp(prefix="collage-benchmark-")
+    sketch = raster.Sketch(400, 400, data_path)
+    rng = random.Random(seed)
+    for folder in ("parts", "comparator_samples"):
+        os.makedirs(sketch.dataPath(folder))
+    for i in range(num_parts):
+        synthetic_part(rng, part_size).save(os.path.join(sketch.dataPath("parts"), "part-{:02d}.png".format(i)))
+    for i in range(num_samples):
+        synthetic_sample(rng, sample_size).save(os.path.join(sketch.dataPath("comparator_samples"), "sample-{:02d}.png".format(i)))
+    return sketch
+
+
+def reset_comparator(mode):
+    '''Forget the preprocessed samples so they are preprocessed again in the given mode.'''
+    ic.config_preprocess_mode = mode
+    del ic.sample_images[:]
+    del ic.samples[:]
+    del ic.sample_sources[:]
+    ic.engines.clear()
+
+
+def reset_drawing(layout, count):
+    drawing.config_layout = layout
+    drawing.config_number_of_parts = count
+    drawing.config_snap_angles = [0, 90, 180, 270]
+    drawing.initialize()
+
+
+def best_time(func, repeats):
+    '''Return the shortest of several timed calls of func, and its result.'''
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+    return min(times), result
+
+
+def checksum(values):
+    return round(sum(values), 6)
+
+
+def benchmark_render(sketch, seed, repeats):
+    results = []
+    w, h = ic.evaluation_size(sketch.width, sketch.height)
+    for layout in render_layouts:
+        for count in render_part_counts:
+            reset_drawing(layout, count)
+            rng = random.Random(seed)
+            genomes = [[rng.random() for g in range(drawing.num_params())] for i in range(render_count)]
+            render = lambda: [int(drawing.render_offscreen(sketch, genes, w, h).pixels.sum()) for genes in genomes]
+            render() # Warm up the parts catalog and sprite cache
+            seconds, sums = best_time(render, repeats)
+            results.append({
+                "layout": layout, "parts": count, "width": w, "height": h, "renders": render_count,
+                "seconds": seconds, "renders_per_sec": render_count / seconds, "checksum": checksum(sums),
+                })
+            print("render   {:<12} parts={:<3} {:8.1f} renders/sec".format(layout, count, render_count / seconds))
+    return results
+
+
+def benchmark_samples(sketch, repeats):
+    results = []
+    cache_path = os.path.join(utils.app_data_path(sketch, "cache"), "samples")
+    for mode in compare_modes:
+        def load(cached):
+            if not cached:
+                shutil.rmtree(cache_path, True)
+            reset_comparator(mode)
+            ic.load_samples(sketch)
+            return [sum(pixels) for pixels in ic.samples]
+        for cached in (False, True):
+            seconds, sums = best_time(lambda: load(cached), repeats)
+            results.append({
+                "mode": mode, "cached": cached, "samples": len(sums),
+                "seconds": seconds, "checksum": checksum(sums),
+                })
+            print("samples  {:<12} {:<9} {:8.3f} sec".format(mode, "cached" if cached else "uncached", seconds))
+    return results
+
+
+def benchmark_compare(sketch, seed, repeats):
+    results = []
+    for mode in compare_modes:
+        reset_comparator(mode)
+        for strictness in range(1, len(ic.comparison_sizes) + 1):
+            rng = random.Random(seed)
+            w, h = ic.evaluation_size(sketch.width, sketch.height, strictness)
+            images = [raster.Image(w, h, [raster.color(rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)) for p in range(w * h)]) for i in range(compare_count)]
+            compare = lambda: [ic.compare(sketch, img, strictness) for img in images]
+            compare() # Warm up the samples and pixel lookups for this level
+            seconds, scores = best_time(compare, repeats)
+            results.append({
+                "mode": mode, "strictness": strictness, "pixels": w * h, "comparisons": compare_count,
+                "seconds": seconds, "comparisons_per_sec": compare_count / seconds, "checksum": checksum(scores),
+                })
+            print("compare  {:<12} strictness={} {:8.1f} comparisons/sec".format(mode, strictness, compare_count / seconds))
+    return results
+
+
+def benchmark_evolve(sketch, seed, generations):
+    reset_drawing("GridLayout", 25)
+    reset_comparator("gray")
+    w, h = ic.evaluation_size(sketch.width, sketch.height)
+    random.seed(seed) # The solver draws from the global random generator
+    evolver = genetic.Evolver()
+    start = time.time()
+    evolver.initialize(drawing.num_params(), lambda genes: drawing.render_offscreen(sketch, genes, w, h), lambda img: ic.compare(sketch, img))
+    init_seconds = time.time() - start
+    start = time.time()
+    for i in range(generations):
+        evolver.evolve()
+    seconds = time.time() - start
+    print("evolve   {} generations {:8.2f} generations/sec".format(generations, generations / seconds))
+    return {
+        "generations": generations, "population": len(evolver.population), "initialize_seconds": init_seconds,
+        "seconds": seconds, "generations_per_sec": generations / seconds, "evaluations": evolver.evaluation_count,
+        "high_score": evolver.state.high_score, "checksum": checksum(evolver.state.fittest.genes),
+        }
+
+
+def run(output=None, generations=10, repeats=3, seed=1):
+    sketch = create_sketch(seed)
+    try:
+        results = {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "seed": seed,
+            "repeats": repeats,
+            "render": benchmark_render(sketch, seed, repeats),
+            "samples": benchmark_samples(sketch, repeats),
+            "compare": benchmark_compare(sketch, seed, repeats),
+            "evolve": benchmark_evolve(sketch, seed, generations),
+            }
+    finally:
+        shutil.rmtree(sketch.data_path, True)
+    if output:
+        f = open(output, "w")
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+        print("Results saved to <{}>.".format(output))
+    return results
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    output = args[0] if len(args) > 0 else None
+    generations = int(args[1]) if len(args) > 1 else 10
+    repeats = int(args[2]) if len(args) > 2 else 3
+    run(output, generations, repeats)
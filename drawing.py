@@ -5,8 +5,15 @@ a drawing from a genome.
 """
 import os
 import math
+import random
+import collections
+import threading
 import utils
 import settings as config
+try:
+    radians, sqrt, color # Builtins in Processing
+except NameError:
+    from raster import radians, sqrt, color # Running outside of Processing on the raster backend
 
 
 ### Default Settings - Don't change these here. Instead, change them in the settings.py file ###
@@ -27,29 +34,50 @@ config_crop_to_cell = False # Crops any part that overflows the grid cell dimens
 config_nudge_factor_max = 0.0 # A multiple of the grid cell dimension. Set to 0 to disable nudge and keep parts in center of cells.
 config_render_grid = False # Specify whether you want to preview the grid
 config_number_of_columns = None
+config_cell_fitness_tables = False # With config_crop_to_cell, score drawings by adding up memoized scores of their cells instead of rendering them
 
 # Rendering
 hi_res_width = 1200
+config_mipmap_min_size = 16 # Smallest side length (pixels) of the pre-scaled copies of each part
+config_sprite_cache_bytes = 32 * 1024 * 1024 # Memory budget for pre-rotated copies of parts at snap angles
+config_atlas_rendering = False # Render all of the drawings evaluated together as tiles of one offscreen buffer
+config_incremental_rendering = False # Render and score children by redrawing only where they differ from a parent
+config_parts_cache = True # Remember the sizes and pre-scaled copies of parts in the cache folder so unchanged parts load quickly
+config_lazy_parts = False # Keep only small copies of parts in memory and load the larger ones when they are drawn. Uses the parts cache.
+config_part_proxy_size = 128 # Longest side (pixels) of the largest pre-scaled copies of parts that lazy loading keeps in memory
+config_parts_memory_bytes = 256 * 1024 * 1024 # Memory budget for the copies of parts that are loaded from file when drawn
 
 
 class Part(object):
     
     def __init__(self, canvas, catalog, image_param, scale_param=None):
-        self.image, self.z_order, self.filename = catalog.pick(image_param)
+        self.z_order, self.filename = catalog.pick(image_param)
+        width, height = catalog.sizes[self.z_order][0]
         imgscale = canvas.width / float(hi_res_width) # Assume that images are scaled to hi-res version
         imgscale *= config_part_uniform_scale
         if scale_param is not None:
             partscale = utils.remap(scale_param, config_part_scale_min, config_part_scale_max)
             imgscale *= partscale
-        self.w = self.image.width * imgscale 
-        self.h = self.image.height * imgscale
+        self.w = width * imgscale 
+        self.h = height * imgscale
+        self.catalog = catalog
+        self.level = catalog.level_for(self.z_order, self.w, self.h)
+        self.source = catalog.image(self.z_order, self.level) # Pre-scaled copy to draw from
+        self.sprite = None
+        self.index = None # Position of the part's genes in the genome
+        self.cell = None # Grid cell that the part is cropped to, if any
     
-    def set_rotation(self, param, snap_angles, jitter):
+    def set_rotation(self, param, snap_angles, jitter, rng=None):
         angles = snap_angles if snap_angles else range(359)
         i = utils.normalized_value_to_index(param, angles)
         angle = angles[i]
-        angle = utils.jitter(angle, jitter)
+        if jitter:
+            angle = utils.jitter(angle, jitter, rng) # Only draw from the random generator when there is jitter
         self.rotation = angle
+        self.sprite = None
+        if snap_angles and not jitter and angle % 360:
+            # Only a few distinct angles are possible so draw from a pre-rotated copy
+            self.sprite = self.catalog.rotated(self.z_order, self.level, angle)
     
     def set_position(self, cx, cy):
         self.cx = cx
@@ -57,12 +85,44 @@ class Part(object):
         self.x = self.cx - self.w / 2.0
         self.y = self.cy - self.h / 2.0
         
+    def bounds(self):
+        '''Return the box (left, top, right, bottom) that the part
+        covers when it is rendered, allowing for its rotation.'''
+        angle = radians(self.rotation)
+        cos_a, sin_a = abs(math.cos(angle)), abs(math.sin(angle))
+        half_w = (self.w * cos_a + self.h * sin_a) / 2.0
+        half_h = (self.w * sin_a + self.h * cos_a) / 2.0
+        return self.cx - half_w, self.cy - half_h, self.cx + half_w, self.cy + half_h
+        
+    def render_key(self):
+        '''Return what render() draws: the part, pre-scaled copy and
+        angle, and the rectangle it is drawn into. Processing draws
+        images into rectangles truncated to whole pixels, so parts
+        that only differ within a pixel share a key, except rotated
+        parts that are not drawn from a pre-rotated copy.'''
+        if self.sprite is not None:
+            s = self.w / float(self.source.width)
+            sw, sh = self.sprite.width * s, self.sprite.height * s
+            x, y = self.cx - sw / 2.0, self.cy - sh / 2.0
+            return (self.z_order, self.level, self.rotation, int(x), int(y), int(x + sw), int(y + sh))
+        if not self.rotation:
+            return (self.z_order, self.level, 0, int(self.x), int(self.y), int(self.x + self.w), int(self.y + self.h))
+        return (self.z_order, self.level, self.rotation, self.x, self.y, self.w, self.h)
+        
     def render(self, canvas):
+        if self.sprite is not None:
+            s = self.w / float(self.source.width)
+            sw, sh = self.sprite.width * s, self.sprite.height * s
+            canvas.image(self.sprite, self.cx - sw / 2.0, self.cy - sh / 2.0, sw, sh)
+            return
+        if not self.rotation:
+            canvas.image(self.source, self.x, self.y, self.w, self.h)
+            return
         canvas.pushMatrix()
         canvas.translate(self.cx, self.cy)
         canvas.rotate(radians(self.rotation))
         canvas.translate(-self.cx, -self.cy)
-        canvas.image(self.image, self.x, self.y, self.w, self.h)
+        canvas.image(self.source, self.x, self.y, self.w, self.h)
         canvas.popMatrix()
         
         
@@ -78,23 +138,33 @@ class PointLayout(object):
         if self.scale_disabled:
             self.params_per_part -= 1
     
-    def build_parts(self, catalog, params, canvas):
+    def split_params(self, partparams):
+        '''Return the genes of one part as (scale, image, position, rotation).'''
+        p = list(partparams) # Make a copy so we can remove items from front of list until empty
+        scale = None if self.scale_disabled else p.pop(0)
+        image = p.pop(0)
+        position = (p.pop(0), p.pop(0))
+        rotation = 0 if config_disable_rotation else p.pop(0)
+        return scale, image, position, rotation
+    
+    def build_parts(self, catalog, params, canvas, rng=None):
         parts = []
-        for partparams in params:
-            p = list(partparams) # Make a copy so we can remove items from front of list until empty
-            scale = None if self.scale_disabled else p.pop(0)
-            part = Part(canvas, catalog, p.pop(0), scale)
-            cx = p.pop(0) * canvas.width
-            cy = p.pop(0) * canvas.height
+        for i, partparams in enumerate(params):
+            scale, image, position, rotation_angle = self.split_params(partparams)
+            part = Part(canvas, catalog, image, scale)
+            part.index = i
+            cx = position[0] * canvas.width
+            cy = position[1] * canvas.height
             part.set_position(cx, cy)
-            rotation_angle = 0 if config_disable_rotation else p.pop(0)
-            part.set_rotation(rotation_angle, config_snap_angles, config_rotation_jitter)
+            part.set_rotation(rotation_angle, config_snap_angles, config_rotation_jitter, rng)
             parts.append(part)
         parts = sort_z(parts)
         return parts
     
-    def render(self, sketch, catalog, params, canvas):
-        for part in self.build_parts(catalog, params, canvas):
+    def render(self, sketch, catalog, params, canvas, rng=None, subset=None, draw_grid=True):
+        '''Render the parts, or only those at the given positions in drawing order.'''
+        for i, part in enumerate(self.build_parts(catalog, params, canvas, rng)):
+            if subset is not None and i not in subset: continue
             part.render(canvas)
             
 
@@ -113,42 +183,59 @@ class GridLayout(object):
         if config_nudge_factor_max > 0:
             self.params_per_part += 2
         
-    def build_parts(self, catalog, params, canvas):
+    def split_params(self, partparams):
+        '''Return the genes of one part as (scale, image, nudge, rotation).'''
+        p = list(partparams) # Make a copy so we can remove items from front of list until empty
+        scale = None if self.scale_disabled else p.pop(0)
+        image = p.pop(0)
+        nudge = (p.pop(0), p.pop(0)) if config_nudge_factor_max > 0 else ()
+        rotation = 0 if config_disable_rotation else p.pop(0)
+        return scale, image, nudge, rotation
+        
+    def build_grid(self, canvas, count):
         if config_number_of_columns is None:
-            rows = cols = int(math.ceil(sqrt(len(params))))
+            rows = cols = int(math.ceil(sqrt(count)))
         else:
             cols = config_number_of_columns
-            rows = max(1, int(math.ceil(len(params) / float(cols))))
-        self.grid = utils.Grid(canvas.width, canvas.height, cols, rows)
+            rows = max(1, int(math.ceil(count / float(cols))))
+        return utils.Grid(canvas.width, canvas.height, cols, rows)
+        
+    def build_parts(self, catalog, params, canvas, rng=None):
+        grid = self.build_grid(canvas, len(params))
         parts = []
-        for i in range(min(len(params), len(self.grid.cells))):
-            p = list(params[i]) # Make a copy so we can remove items from front of list until empty
-            cell = self.grid.cells[i]
-            scale = None if self.scale_disabled else p.pop(0)
-            part = Part(canvas, catalog, p.pop(0), scale)
-            nudge_x, nudge_y = self._get_nudge(cell, p)
+        for i in range(min(len(params), len(grid.cells))):
+            cell = grid.cells[i]
+            scale, image, nudge, rotation_angle = self.split_params(params[i])
+            part = Part(canvas, catalog, image, scale)
+            part.index = i
+            nudge_x, nudge_y = self._get_nudge(cell, list(nudge))
             if config_crop_to_cell:
+                part.cell = cell
                 cx, cy = cell.width / 2.0, cell.height / 2.0
             else:
                 cx, cy = cell.cx, cell.cy
             part.set_position(cx + nudge_x, cy + nudge_y)
-            rotation_angle = 0 if config_disable_rotation else p.pop(0)
-            part.set_rotation(rotation_angle, config_snap_angles, config_rotation_jitter)
+            part.set_rotation(rotation_angle, config_snap_angles, config_rotation_jitter, rng)
             parts.append(part)
         if not config_crop_to_cell:
             parts = sort_z(parts)
         return parts
             
-    def render(self, sketch, catalog, params, canvas):
-        parts = self.build_parts(catalog, params, canvas)
-        if config_render_grid:
-            self._render_grid(sketch)
-        for i in range(min(len(parts), len(self.grid.cells))):
-            cell = self.grid.cells[i]
+    def render(self, sketch, catalog, params, canvas, rng=None, subset=None, draw_grid=True):
+        '''Render the parts, or only those at the given positions in
+        drawing order, which are the cells when parts are cropped to
+        them. The grid is drawn first if config_render_grid and
+        draw_grid are set.'''
+        parts = self.build_parts(catalog, params, canvas, rng)
+        grid = self.build_grid(canvas, len(params))
+        if config_render_grid and draw_grid:
+            self._render_grid(canvas, grid)
+        for i in range(min(len(parts), len(grid.cells))):
+            if subset is not None and i not in subset: continue
+            cell = grid.cells[i]
             part = parts[i]
             if config_crop_to_cell:
-                graphics = utils.GraphicsBuffer(sketch.createGraphics, cell.width, cell.height)
-                graphics = sketch.createGraphics(int(cell.width), int(cell.height))
+                graphics = utils.GraphicsBuffer(sketch.createGraphics, int(cell.width), int(cell.height))
                 graphics.beginDraw()
                 graphics.clear()
                 target = graphics
@@ -168,38 +255,243 @@ class GridLayout(object):
         nudge_y = params.pop(0) * nudge_max_y * 2 - nudge_max_y
         return nudge_x, nudge_y
         
-    def _render_grid(self, sketch):
+    def _render_grid(self, canvas, grid):
         c1 = color(255,0,0,100)
         c2 = color(0,0,255,100)
         colors = [c1, c2, c1]
-        for cell in self.grid.cells:
+        for cell in grid.cells:
             color_idx = cell.col % 2 + cell.row % 2
-            sketch.fill(colors[color_idx])
-            sketch.rect(cell.left, cell.top, cell.width, cell.height)
-            sketch.noFill()
+            canvas.fill(colors[color_idx])
+            canvas.rect(cell.left, cell.top, cell.width, cell.height)
+            canvas.noFill()
     
     
-def render(sketch, params, canvas=None):
+def render(sketch, params, canvas=None, subset=None, transparent=False):
     '''Create the drawing, using parts provided
     by the specified layout object. 
+    
+    With subset, only the parts at those positions in drawing
+    order are drawn. With transparent, the canvas is cleared
+    rather than given a background, and no grid is drawn.
     '''
     if canvas is None: 
         canvas = sketch # If no canvas was provided then use the sketch
-    canvas.background(255)
-    try: 
-        draw_background(params, canvas)
-    except Exception: 
-        pass
+    if transparent:
+        canvas.clear()
+    else:
+        canvas.background(255)
+        try: 
+            draw_background(params, canvas)
+        except Exception: 
+            pass
     canvas.noFill()
     canvas.pushMatrix()
-    canvas.scale(config_canvas_scale)
+    apply_margins(canvas)
+    partsparams = utils.partition_list(params, layout.params_per_part)
+    catalog = PartsCatalog(sketch)
+    if subset is None:
+        layout.render(sketch, catalog, partsparams, canvas, jitter_rng(sketch, params))
+    else:
+        layout.render(sketch, catalog, partsparams, canvas, jitter_rng(sketch, params), subset, not transparent)
+    canvas.popMatrix()
+
+
+def apply_margins(canvas):
+    '''Scale and translate the canvas to leave the margins of config_canvas_scale around the drawing.'''
+    scale, marginx, marginy = margins(canvas)
+    canvas.scale(scale)
+    canvas.translate(marginx, marginy)
+
+
+def margins(canvas):
+    '''Return the scale and the translation applied by apply_margins().'''
     marginx = canvas.width * (1.0-config_canvas_scale) / 2.0
     marginy = canvas.height * (1.0-config_canvas_scale) / 2.0
-    canvas.translate(marginx, marginy)
+    return config_canvas_scale, marginx, marginy
+
+
+def part_boxes(sketch, params, canvas):
+    '''Return the box (left, top, right, bottom) of canvas pixels
+    that each part of the drawing can change, in genome order, and
+    the position of each part in drawing order. Boxes are widened
+    by a pixel to allow for smoothing.
+    '''
+    partsparams = utils.partition_list(params, layout.params_per_part)
+    parts = layout.build_parts(PartsCatalog(sketch), partsparams, canvas, jitter_rng(sketch, params))
+    scale, marginx, marginy = margins(canvas)
+    boxes, positions = [None] * len(partsparams), [None] * len(partsparams)
+    for position, part in enumerate(parts):
+        left, top, right, bottom = part.bounds()
+        if part.cell is not None: # Cropped to its cell and drawn at the cell's corner
+            cell = part.cell
+            left, top = max(left, 0) + cell.left, max(top, 0) + cell.top
+            right, bottom = min(right, int(cell.width)) + cell.left, min(bottom, int(cell.height)) + cell.top
+        boxes[part.index] = (
+            max(0, int(math.floor(scale * (left + marginx))) - 1),
+            max(0, int(math.floor(scale * (top + marginy))) - 1),
+            min(canvas.width, int(math.ceil(scale * (right + marginx))) + 1),
+            min(canvas.height, int(math.ceil(scale * (bottom + marginy))) + 1),
+            )
+        positions[part.index] = position
+    return boxes, positions
+
+
+def render_regions(sketch, params, canvas, regions, boxes=None):
+    '''Draw the drawing again inside each of the given boxes of canvas
+    pixels, drawing only the parts that can reach the box. The canvas
+    must already hold a drawing that differs from this one only inside
+    the boxes. Pass what part_boxes() returned for params as boxes if
+    it is already known.'''
+    boxes, positions = boxes or part_boxes(sketch, params, canvas)
     partsparams = utils.partition_list(params, layout.params_per_part)
     catalog = PartsCatalog(sketch)
-    layout.render(sketch, catalog, partsparams, canvas)
-    canvas.popMatrix()
+    for region in regions:
+        left, top, right, bottom = region
+        subset = set(position for box, position in zip(boxes, positions) if box and overlaps(box, region))
+        canvas.clip(left, top, right - left, bottom - top)
+        canvas.pushStyle()
+        canvas.noStroke()
+        canvas.fill(255)
+        canvas.rect(left, top, right - left, bottom - top) # background() would ignore the clip
+        canvas.popStyle()
+        canvas.noFill()
+        canvas.pushMatrix()
+        apply_margins(canvas)
+        layout.render(sketch, catalog, partsparams, canvas, jitter_rng(sketch, params), subset)
+        canvas.popMatrix()
+    canvas.noClip()
+
+
+def overlaps(a, b):
+    '''Return True if the boxes (left, top, right, bottom) overlap.'''
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def jitter_rng(sketch, params):
+    '''Return a random number generator for rotation jitter that is
+    seeded from the decoded genome, so that a genome always renders
+    the same way whichever thread or canvas it is rendered on.'''
+    if not config_rotation_jitter:
+        return None
+    return random.Random(hash(genome_key(sketch, params)))
+
+
+def render_offscreen(sketch, params, width, height):
+    '''Render the drawing into an offscreen buffer of the given
+    size and return a copy of the result. Use this to render at
+    the comparator resolution without touching the sketch window.
+    '''
+    timer = utils.profiler.start()
+    canvas = utils.GraphicsBuffer(sketch.createGraphics, width, height)
+    canvas.beginDraw()
+    render(sketch, params, canvas)
+    canvas.endDraw()
+    utils.profiler.stop("render", timer)
+    timer = utils.profiler.start()
+    image = canvas.get()
+    utils.profiler.stop("grab", timer)
+    return image
+
+
+def render_atlas(sketch, genomes, width, height):
+    '''Render each genome into its own tile of one offscreen buffer,
+    within a single beginDraw() and endDraw(), and return the tiles
+    as images of the given size. This sets up the canvas and reads
+    its pixels back once for all of the genomes rather than once
+    for each of them as render_offscreen() does.
+    '''
+    cols = int(math.ceil(math.sqrt(len(genomes))))
+    rows = int(math.ceil(len(genomes) / float(cols)))
+    timer = utils.profiler.start()
+    atlas = utils.GraphicsBuffer(sketch.createGraphics, cols * width, rows * height)
+    atlas.beginDraw()
+    for i, params in enumerate(genomes):
+        x, y = i % cols * width, i // cols * height
+        atlas.clip(x, y, width, height) # Keep parts that overflow the drawing out of the neighbouring tiles
+        atlas.pushMatrix()
+        atlas.translate(x, y)
+        render(sketch, params, AtlasTileCanvas(atlas, width, height))
+        atlas.popMatrix()
+    atlas.noClip()
+    atlas.endDraw()
+    utils.profiler.stop("render", timer)
+    timer = utils.profiler.start()
+    atlas.loadPixels()
+    pixels = atlas.pixels
+    tiles = []
+    for i in range(len(genomes)):
+        x, y = i % cols * width, i // cols * height
+        if hasattr(pixels, "reshape"):
+            tile = pixels.reshape(atlas.height, atlas.width)[y:y + height, x:x + width].reshape(-1) # NumPy on the raster backend
+        else:
+            tile = []
+            for row in range(y, y + height):
+                start = row * atlas.width + x
+                tile.extend(pixels[start:start + width])
+        tiles.append(AtlasTile(sketch, width, height, tile))
+    utils.profiler.stop("grab", timer)
+    return tiles
+
+
+class AtlasTileCanvas(object):
+    '''Presents one tile of an atlas to render() as a canvas of the
+    tile's size. Everything but background() is drawn on the atlas.'''
+    
+    def __init__(self, atlas, width, height):
+        self.atlas = atlas
+        self.width = width
+        self.height = height
+        
+    def background(self, gray):
+        self.atlas.pushStyle()
+        self.atlas.noStroke()
+        self.atlas.fill(gray)
+        self.atlas.rect(0, 0, self.width, self.height)
+        self.atlas.popStyle()
+        
+    def __getattr__(self, name):
+        return getattr(self.atlas, name)
+        
+        
+class AtlasTile(object):
+    '''The pixels of one tile read back from an atlas, with the
+    width, height and pixels of an image so that they can be scored
+    without copying them into an image of their own.'''
+    
+    def __init__(self, sketch, width, height, pixels):
+        self.sketch = sketch
+        self.width = width
+        self.height = height
+        self.pixels = pixels
+        
+    def copy(self):
+        img = self.sketch.createImage(self.width, self.height, self.sketch.ARGB)
+        img.loadPixels()
+        for i, p in enumerate(self.pixels):
+            img.pixels[i] = p
+        img.updatePixels()
+        return img
+
+
+def genome_key(sketch, params):
+    '''Decode a genome into the choices it actually resolves to when
+    rendered, so that genomes which draw the same thing share a key.
+    Part and angle genes become indices; scale and position genes are
+    continuous and are kept as they are.
+    '''
+    catalog = PartsCatalog(sketch)
+    angles = config_snap_angles if config_snap_angles else range(359)
+    key = []
+    for partparams in utils.partition_list(params, layout.params_per_part):
+        scale, image, position, rotation = layout.split_params(partparams)
+        key.append((utils.normalized_value_to_index(image, catalog.filenames),
+                    utils.normalized_value_to_index(rotation, angles),
+                    scale,
+                    tuple(position)))
+    return tuple(key)
+
+
+lock = threading.RLock() # Guards the parts catalog when rendering on several threads
 
 
 def initialize():
@@ -230,42 +522,287 @@ def sort_z(parts):
  
 class PartsCatalog(object):
     '''Encapsulate a catalog of parts.
+    
+    Each part is kept as a pyramid of pre-scaled copies. Normally
+    every copy is in memory, except that parts found in the parts
+    cache are only loaded at full size when they are drawn at that
+    size. With config_lazy_parts only the copies
+    no larger than config_part_proxy_size are, which is all that
+    rendering at the comparator resolution needs, and the larger
+    ones are loaded from the parts cache when they are drawn.
     '''
     # Enforce a singleton pattern
     _instance = None
     def __new__(cls, sketch):
+        with lock:
+            return cls._create(sketch)
+    
+    @classmethod
+    def _create(cls, sketch):
         if cls._instance is None:
             inst = super(PartsCatalog, cls).__new__(cls)
-            inst.parts = []
             inst.folder_name = "parts"
             folderpath = utils.app_data_path(sketch, inst.folder_name)
             inst.folder_path = folderpath
-            inst.filenames = utils.listfiles(folderpath, fullpath=False)
-            for filepath in utils.listfiles(folderpath, fullpath=True):
-                img = sketch.loadImage(filepath)
-                if img is not None:
-                    inst.parts.append(img)
+            inst.filenames = []
+            inst.pyramids = [] # Copies of each part, or None for copies that are not in memory
+            inst.sizes = [] # Width and height of each copy of each part
+            inst.paths = [] # File of each copy of each part, when they are cached
+            inst.info = [] # Size, opaque pixel count and opaque bounds of each part
+            cache = PartsMetadataCache(sketch) if config_parts_cache or config_lazy_parts else None
+            for filename in utils.listfiles(folderpath, fullpath=False):
+                filepath = os.path.join(folderpath, filename)
+                if cache is not None:
+                    entry, pyramid = cache.lookup(filepath)
+                    if entry is not None and pyramid is None:
+                        pyramid = cache.load_pyramid(filepath, entry, config_lazy_parts)
+                        if pyramid is None:
+                            entry, pyramid = cache.lookup(filepath, rebuild=True) # A cached copy went missing
+                    if entry is None: continue
+                    info = entry["info"]
+                    paths = [filepath] + [levelpath for levelpath, w, h in entry["levels"]]
+                    sizes = [(info["width"], info["height"])] + [(w, h) for levelpath, w, h in entry["levels"]]
+                else:
+                    img = sketch.loadImage(filepath)
+                    if img is None: continue
+                    pyramid = build_pyramid(img, config_mipmap_min_size)
+                    paths = [filepath] + [None] * (len(pyramid) - 1)
+                    sizes = [(level.width, level.height) for level in pyramid]
+                    info = analyse_part(sketch, img)
+                if config_lazy_parts:
+                    pyramid = [level if max(size) <= config_part_proxy_size else None for level, size in zip(pyramid, sizes)]
+                inst.filenames.append(filename)
+                inst.pyramids.append(pyramid)
+                inst.sizes.append(sizes)
+                inst.paths.append(paths)
+                inst.info.append(info)
+            if cache is not None:
+                cache.save()
             inst.sort(sketch)
+            inst.sketch = sketch
+            inst.sprites = collections.OrderedDict()
+            inst.sprite_bytes = 0
+            inst.loaded = collections.OrderedDict()
+            inst.loaded_bytes = 0
             cls._instance = inst
         return cls._instance
     
     def sort(self, sketch):
         if config_sort_parts_by_filename:
-            self.parts = utils.sort_by_key(self.parts, self.filenames)
-            self.filenames = utils.sort_by_key(self.filenames, self.filenames)
+            keys, reverse = list(self.filenames), False
         else:
-            sizes = []
-            for img in self.parts:
-                sizes.append(len([1 for p in img.pixels if sketch.alpha(p) > 0]))
-            self.parts = utils.sort_by_key(self.parts, sizes, reverse=True)
-            self.filenames = utils.sort_by_key(self.filenames, sizes, reverse=True)
-                
+            keys, reverse = [info["coverage"] for info in self.info], True
+        for name in ("filenames", "pyramids", "sizes", "paths", "info"):
+            setattr(self, name, utils.sort_by_key(getattr(self, name), keys, reverse))
+    
     def pick(self, idx_normalized):
-        if not self.parts:
+        if not self.filenames:
             raise RuntimeError("{} module: No parts in catalog. Did you put images in the {} folder?".format(__name__, self.folder_path))
-        i = utils.normalized_value_to_index(idx_normalized, self.parts)
+        i = utils.normalized_value_to_index(idx_normalized, self.filenames)
         #print idx_normalized, i
-        return self.parts[i], i, self.filenames[i]
+        return i, self.filenames[i]
+    
+    def image(self, i, level=0):
+        '''Return the given pre-scaled copy of part i. Copies that are
+        not kept in memory are loaded on first use and the least
+        recently used ones are dropped when they take up more than
+        config_parts_memory_bytes.
+        '''
+        img = self.pyramids[i][level]
+        if img is not None:
+            return img
+        key = (i, level)
+        with lock:
+            img = self.loaded.pop(key, None)
+            if img is None:
+                img = self.sketch.loadImage(self.paths[i][level])
+                if img is None:
+                    raise IOError("Could not load part <{}>. Was it removed while the sketch was running?".format(self.paths[i][level]))
+                self.loaded_bytes += img.width * img.height * 4
+            self.loaded[key] = img # Reinsert to mark as most recently used
+            while self.loaded_bytes > config_parts_memory_bytes and len(self.loaded) > 1:
+                _, old = self.loaded.popitem(last=False)
+                self.loaded_bytes -= old.width * old.height * 4
+            return img
+    
+    def level_for(self, i, w, h):
+        '''Return the index of the smallest pre-scaled copy of part i
+        that is at least w by h pixels, so that drawing it at that size
+        only ever scales down by less than half.
+        '''
+        sizes = self.sizes[i]
+        for level in reversed(range(len(sizes))):
+            if sizes[level][0] >= w and sizes[level][1] >= h:
+                return level
+        return 0
+    
+    def rotated(self, i, level, angle):
+        '''Return a copy of the given pyramid level of part i rotated
+        by angle degrees about its center. Copies are built on first
+        use and the least recently used ones are dropped when they
+        take up more than config_sprite_cache_bytes.
+        '''
+        key = (i, level, angle)
+        with lock:
+            sprite = self.sprites.pop(key, None)
+            if sprite is None:
+                sprite = rotate_image(self.sketch, self.image(i, level), angle)
+                self.sprite_bytes += sprite.width * sprite.height * 4
+            self.sprites[key] = sprite # Reinsert to mark as most recently used
+            while self.sprite_bytes > config_sprite_cache_bytes and len(self.sprites) > 1:
+                _, old = self.sprites.popitem(last=False)
+                self.sprite_bytes -= old.width * old.height * 4
+            return sprite
+
+
+class PartsMetadataCache(object):
+    '''Remember what the catalog works out about each part between
+    runs, in cache/parts.pkl in the data folder. Entries are keyed by
+    file path and hold the file size and modification time, the
+    analysis of analyse_part() and the pre-scaled copies of the
+    pyramid, which are saved as PNG files next to it. Only parts that
+    are new or have changed since the last run are analysed again.
+    '''
+    version = 1 # Increase to discard caches written by older versions
+    
+    def __init__(self, sketch):
+        self.sketch = sketch
+        self.folder_path = utils.app_data_path(sketch, "cache")
+        self.images_path = os.path.join(self.folder_path, "parts")
+        self.filepath = os.path.join(self.folder_path, "parts.pkl")
+        self.entries = {}
+        self.seen = set()
+        self.changed = False
+        try:
+            saved = utils.load_object(self.filepath)
+            if saved.get("version") == self.version:
+                self.entries = saved["entries"]
+        except Exception:
+            pass # No cache yet, or an unreadable one, so start afresh
+    
+    def signature(self, filepath):
+        stat = os.stat(filepath)
+        return (stat.st_size, stat.st_mtime)
+    
+    def lookup(self, filepath, rebuild=False):
+        '''Return the entry for the part in filepath, and its pyramid
+        if the part had to be loaded and analysed because it is new or
+        has changed, or None for the pyramid if the entry was cached.
+        Return None for both if the file is not an image.'''
+        self.seen.add(filepath)
+        signature = self.signature(filepath)
+        entry = self.entries.get(filepath)
+        if not rebuild and entry is not None and entry["signature"] == signature and entry["min_size"] == config_mipmap_min_size:
+            return entry, None
+        img = self.sketch.loadImage(filepath)
+        if img is None:
+            return None, None
+        pyramid = build_pyramid(img, config_mipmap_min_size)
+        entry = {
+            "signature": signature,
+            "min_size": config_mipmap_min_size,
+            "info": analyse_part(self.sketch, img),
+            "levels": self.save_pyramid(filepath, pyramid),
+            }
+        self.entries[filepath] = entry
+        self.changed = True
+        return entry, pyramid
+    
+    def load_pyramid(self, filepath, entry, lazy=False):
+        '''Return the part in filepath followed by its saved pre-scaled
+        copies, or None if any of them is missing or is not the expected
+        size. The part itself is left as None, for PartsCatalog.image()
+        to load when it is drawn at full size, unless it has no
+        pre-scaled copies. If lazy, the copies larger than
+        config_part_proxy_size are left as None too.'''
+        info = entry["info"]
+        pyramid = []
+        for levelpath, w, h in [(filepath, info["width"], info["height"])] + list(entry["levels"]):
+            if not os.path.exists(levelpath):
+                return None
+            if (not pyramid and entry["levels"]) or (lazy and max(w, h) > config_part_proxy_size):
+                pyramid.append(None)
+                continue
+            level = self.sketch.loadImage(levelpath)
+            if level is None or level.width != w or level.height != h:
+                return None
+            pyramid.append(level)
+        return pyramid
+    
+    def save_pyramid(self, filepath, pyramid):
+        utils.create_folder(self.folder_path)
+        utils.create_folder(self.images_path)
+        name = os.path.basename(filepath)
+        levels = []
+        for i, level in enumerate(pyramid[1:]):
+            levelpath = os.path.join(self.images_path, "{}.{}.png".format(name, i + 1))
+            level.save(levelpath)
+            levels.append((levelpath, level.width, level.height))
+        return levels
+    
+    def save(self):
+        '''Forget the parts that have been removed from the parts folder
+        and write the cache if anything changed.'''
+        for filepath in [f for f in self.entries if f not in self.seen]:
+            for levelpath, w, h in self.entries.pop(filepath)["levels"]:
+                if os.path.exists(levelpath):
+                    os.remove(levelpath)
+            self.changed = True
+        if self.changed:
+            utils.create_folder(self.folder_path)
+            utils.save_object(self.filepath, {"version": self.version, "entries": self.entries})
+            self.changed = False
+
+
+def analyse_part(sketch, img):
+    '''Return the size of a part, the number of its pixels that are
+    not fully transparent and the bounds (left, top, right, bottom)
+    of those pixels, or None for the bounds if there are none.'''
+    w, h = img.width, img.height
+    img.loadPixels()
+    pixels = img.pixels
+    coverage = 0
+    left, top, right, bottom = w, h, 0, 0
+    for y in range(h):
+        row = [x for x in range(w) if sketch.alpha(pixels[y * w + x]) > 0]
+        if row:
+            coverage += len(row)
+            left, right = min(left, row[0]), max(right, row[-1] + 1)
+            top, bottom = min(top, y), y + 1
+    bounds = (left, top, right, bottom) if coverage else None
+    return {"width": w, "height": h, "coverage": coverage, "bounds": bounds}
+
+
+def rotate_image(sketch, img, angle):
+    '''Return a copy of the image rotated by angle degrees about its
+    center, on a transparent canvas just large enough to hold it.
+    '''
+    a = radians(angle)
+    cos_a, sin_a = abs(math.cos(a)), abs(math.sin(a))
+    w = int(math.ceil(img.width * cos_a + img.height * sin_a - 1e-6))
+    h = int(math.ceil(img.width * sin_a + img.height * cos_a - 1e-6))
+    graphics = sketch.createGraphics(max(1, w), max(1, h))
+    graphics.beginDraw()
+    graphics.clear()
+    graphics.translate(w / 2.0, h / 2.0)
+    graphics.rotate(a)
+    graphics.image(img, -img.width / 2.0, -img.height / 2.0)
+    graphics.endDraw()
+    return graphics.get()
+
+
+def build_pyramid(img, min_size):
+    '''Return a list of copies of the image, starting with the
+    image itself and halving in size until the next copy would
+    be smaller than min_size on its longest side.
+    '''
+    levels = [img]
+    while max(levels[-1].width, levels[-1].height) / 2 >= min_size:
+        prev = levels[-1]
+        level = prev.copy()
+        level.resize(max(1, prev.width / 2), max(1, prev.height / 2))
+        levels.append(level)
+    return levels
 
 
 # Try loading the optional background.py module in case the
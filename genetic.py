@@ -5,12 +5,21 @@ This module provides an implementation of a genetic algorithm.
 import random
 import time
 import math
+import collections
+import bisect
 import utils
 
 
 # Settings
 config_mutation_rate = 0.08
 config_fitness_decimal_places = 3
+config_fitness_cache_size = 128 # Number of evaluated genomes to remember. Set to 0 to disable the cache.
+config_fidelity_levels = [] # Cheaper fidelity levels to screen with first, e.g. comparator strictness [2, 3]. Leave empty to disable.
+config_promotion_ratios = [0.5] # Fraction of individuals promoted from each fidelity level to the next
+config_selection = "rank" # "rank" or "tournament"
+config_rank_exponent = 2 # Mating probability grows with rank to this power in rank selection
+config_elite_count = 0 # Number of fittest individuals carried over unchanged to the next generation
+config_evaluation_threads = 1 # Number of threads that render and score individuals in parallel
 max_stagnant_generations = 100
 update_interval = 10
 verbose = False
@@ -18,6 +27,9 @@ verbose = False
 # Callback functions
 phenotype_function = None
 fitness_function = None
+genome_key_function = None
+coarse_fitness_function = None
+bounded_fitness_function = None
 
 
 class Individual:
@@ -26,6 +38,8 @@ class Individual:
         self.genes = genes
         self.phenotype = None
         self.fitness = None
+        self.coarse_fitness = None
+        self.parent = None # The parent that the genes mostly came from, until evaluated
         
     def randomize(self, genome_size):
         self.genes = [random.random() for g in range(genome_size)]
@@ -47,7 +61,91 @@ class Individual:
         # Mutate
         if random.random() < mutationrate:
             childgenes[random.randint(0, genomelength-1)] = random.random()
-        return Individual(childgenes)
+        child = Individual(childgenes)
+        if differences(childgenes, self.genes) <= differences(childgenes, other.genes):
+            child.parent = self
+        else:
+            child.parent = other
+        return child
+        
+        
+def differences(genes, other):
+    return sum(1 for a, b in zip(genes, other) if a != b)
+    
+
+class FitnessCache(object):
+    '''Remember the phenotype and fitness of recently evaluated genomes
+    so that genomes that decode to the same drawing are not rendered
+    and scored again. The least recently used entry is evicted once
+    the cache holds maxsize entries. Phenotypes can be dropped with
+    keep_phenotypes(), leaving only the fitness of those entries.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        
+    def lookup(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry # Reinsert to mark as most recently used
+        self.hits += 1
+        return entry
+        
+    def store(self, key, phenotype, fitness):
+        self.entries.pop(key, None)
+        self.entries[key] = (phenotype, fitness)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            
+    def keep_phenotypes(self, phenotypes):
+        '''Forget the phenotypes of the entries other than the given
+        ones, keeping only their fitness.'''
+        keep = set(id(phenotype) for phenotype in phenotypes)
+        for key, (phenotype, fitness) in self.entries.items():
+            if phenotype is not None and id(phenotype) not in keep:
+                self.entries[key] = (None, fitness)
+            
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.0
+        
+    def __str__(self):
+        return "{} hits, {} misses ({:.1%} of evaluations saved)".format(self.hits, self.misses, self.hit_rate)
+    
+
+class FidelityStats(object):
+    '''Keep track of how often the ranking of the promoted individuals
+    at the last cheap fidelity level disagrees with their ranking at
+    full fidelity.
+    '''
+    def __init__(self):
+        self.pairs = 0
+        self.discordant_pairs = 0
+        self.generations = 0
+        self.favourite_missed = 0
+        
+    def record(self, finalists):
+        self.generations += 1
+        for i, a in enumerate(finalists):
+            for b in finalists[i+1:]:
+                coarse = cmp(a.coarse_fitness, b.coarse_fitness)
+                fine = cmp(a.fitness, b.fitness)
+                if coarse and fine:
+                    self.pairs += 1
+                    if coarse != fine:
+                        self.discordant_pairs += 1
+        favourite = max(finalists, key=lambda ind: ind.coarse_fitness)
+        if favourite.fitness < max(ind.fitness for ind in finalists):
+            self.favourite_missed += 1
+            
+    def __str__(self):
+        rate = self.discordant_pairs / float(self.pairs) if self.pairs else 0.0
+        return "coarse and fine rankings disagreed on {:.1%} of promoted pairs; the coarse favourite was not the fittest in {} of {} generations".format(rate, self.favourite_missed, self.generations)
     
 
 class EvolverState(object):
@@ -65,7 +163,7 @@ class EvolverState(object):
     def update(self, population):
         self.generation_number += 1
         self.fitness_changed = False
-        fittest = max(population, key=lambda ind: ind.fitness)
+        fittest = max([ind for ind in population if ind.fitness is not None], key=lambda ind: ind.fitness)
         if fittest.fitness > self.high_score:
             self.high_score = fittest.fitness
             self.fitness_changed = True
@@ -96,21 +194,109 @@ class Evolver(object):
     
     def __init__(self):
         self.population = []
+        self.island = None # Set by islands.join() to exchange migrants with other processes
     
-    def initialize(self, genomesize, phenotype_func, fitness_func, popsize=None):
-        ''' Initialize the population and evolver state.'''
+    def initialize(self, genomesize, phenotype_func, fitness_func, key_func=None, coarse_func=None, bounded_func=None, popsize=None, checkpoint=None, batch_func=None, delta_func=None):
+        ''' Initialize the population and evolver state.
+        
+        If key_func is provided it must map a genome to a hashable key
+        that is equal for genomes that render identically. Evaluations
+        are then cached on that key.
+        
+        If coarse_func is provided it must return a cheap estimate of
+        the fitness of a genome at one of config_fidelity_levels. Each
+        generation is then screened at those levels first and only the
+        promoted individuals are evaluated at full fidelity.
+        
+        If bounded_func is provided it must take a phenotype and a
+        bound and return the fitness, or None as soon as the fitness
+        is certain to be below the bound. Tournament selection then
+        stops scoring an opponent once it can no longer win.
+        
+        If checkpoint is provided it must be a snapshot returned by
+        checkpoint(). The search then carries on from where the
+        snapshot was taken without evaluating anything again.
+        
+        If batch_func is provided it must map a list of genomes to
+        their phenotypes in one go. All of the genomes evaluated
+        together are then rendered with one call instead of one
+        phenotype_func call each.
+        
+        If delta_func is provided it must take a genome and the
+        phenotype of a parent that it was bred from and return the
+        phenotype and fitness of the genome, worked out from the
+        parent's, or None if it cannot. Children are then evaluated
+        that way first.
+        '''
         if self.initialized: return
         print("Initializing the solver...")
         self.state = EvolverState()
         self.phenotype_function = phenotype_func
         self.fitness_function = fitness_func
+        self.genome_key_function = key_func
+        self.coarse_function = coarse_func
+        self.bounded_function = bounded_func
+        self.batch_function = batch_func
+        self.delta_function = delta_func
+        self.bounded_evaluations = 0
+        self.abandoned_evaluations = 0
+        self.evaluation_count = 0 # Number of renders and comparisons actually run
+        self.cache = FitnessCache(config_fitness_cache_size) if key_func and config_fitness_cache_size > 0 else None
+        self.fidelity = FidelityStats() if coarse_func and config_fidelity_levels else None
+        self.pool = utils.WorkerPool(config_evaluation_threads, "evaluator") if config_evaluation_threads > 1 else None
+        if checkpoint is not None:
+            self.restore(checkpoint)
+            print("Solver restored at generation {}.".format(self.state.generation_number))
+            return
         if popsize is None:
             popsize = int(round(genomesize * 1.5)) # Or 1.75 is better in general
         self.population = [Individual().randomize(genomesize) for i in range(popsize)]
         self.matingpool = []
+        self.cumulative_weights = None
         self.update_population()
         print("Solver initialized.")
         
+    def checkpoint(self):
+        '''Return a snapshot of the search that can be pickled and
+        passed to initialize() to resume it. It holds the genomes and
+        fitness of the population, the mating pool, the evolver state
+        and the state of the random generator, but not phenotypes.'''
+        position = dict((id(ind), i) for i, ind in enumerate(self.population))
+        fittest = self.state.fittest
+        return {
+            "population": [(ind.genes, ind.fitness, ind.coarse_fitness) for ind in self.population],
+            "matingpool": [position[id(ind)] for ind in self.matingpool],
+            "cumulative_weights": self.cumulative_weights,
+            "fittest": (fittest.genes, fittest.fitness) if fittest else None,
+            "generation_number": self.state.generation_number,
+            "stagnant_count": self.state.stagnant_count,
+            "high_score": self.state.high_score,
+            "elapsed": time.time() - self.state.start_time,
+            "evaluation_count": self.evaluation_count,
+            "random_state": random.getstate(),
+            }
+            
+    def restore(self, checkpoint):
+        self.population = []
+        for genes, fitness, coarse_fitness in checkpoint["population"]:
+            ind = Individual(genes)
+            ind.fitness = fitness
+            ind.coarse_fitness = coarse_fitness
+            self.population.append(ind)
+        self.matingpool = [self.population[i] for i in checkpoint["matingpool"]]
+        self.cumulative_weights = checkpoint["cumulative_weights"]
+        if checkpoint["fittest"]:
+            genes, fitness = checkpoint["fittest"]
+            self.state.fittest = Individual(genes)
+            self.state.fittest.fitness = fitness
+        self.state.generation_number = checkpoint["generation_number"]
+        self.state.stagnant_count = checkpoint["stagnant_count"]
+        self.state.high_score = checkpoint["high_score"]
+        self.state.start_time = time.time() - checkpoint["elapsed"]
+        self.state.end_time = None
+        self.evaluation_count = checkpoint["evaluation_count"]
+        random.setstate(checkpoint["random_state"])
+        
     @property
     def initialized(self):
         return len(self.population) > 0
@@ -123,56 +309,269 @@ class Evolver(object):
             raise RuntimeError("ERROR: Evolver.evolve() called before Evolver has been initialized")
 
         # Make sure the search is not over
-        if self.state.finished: return
+        if self.finished: return
     
-        # Replace the current population with its children
-        newgen = []
-        for i in range(len(self.population)):
-            parent1 = random.choice(self.matingpool)
-            parent2 = random.choice(self.matingpool)
+        # Replace the current population with its children,
+        # keeping the elite individuals as they are
+        timer = utils.profiler.start()
+        newgen = self.elites()
+        for i in range(len(self.population) - len(newgen)):
+            parent1 = self.select_parent()
+            parent2 = self.select_parent()
             child = parent1.breed_with(parent2, config_mutation_rate)
             newgen.append(child)
         self.population = newgen
+        utils.profiler.stop("select", timer)
+        if self.island:
+            self.island.exchange(self)
         self.update_population()
+        for ind in self.population:
+            ind.parent = None # Let the parents go
+        if self.cache and self.delta_function is not None:
+            # Delta phenotypes hold a whole evaluation, so only keep those that can still be bred from.
+            # Children of a cached individual without one are evaluated in full.
+            self.cache.keep_phenotypes([ind.phenotype for ind in self.population])
     
         # Update evolver state
         self.state.update(self.population)
         msg = "Generation={0:04d} Fitness={1}".format(self.state.generation_number, self.state.high_score)
         if verbose and (self.state.is_first_gen or self.state.generation_number % update_interval == 0):
             print("Current state: {}".format(msg))
+            self.print_stats()
         if self.state.fitness_changed:
             print("Fitter solution found [{}]...".format(msg))
-        if self.state.finished: 
+        if self.finished: 
             print("No fitter solution found after {} unchanged generations. Stopping search.".format(self.state.stagnant_count))
+            self.print_stats()
             self.state.end()
             
+    @property
+    def finished(self):
+        '''The search is over when this population has stagnated and,
+        in the island model, every other island has stagnated too.'''
+        return self.state.finished and (self.island is None or self.island.all_finished())
+        
+    def immigrate(self, genomes):
+        '''Replace the last children of the new generation with
+        individuals grown from genomes sent by other islands.'''
+        start = len(self.population) - len(genomes)
+        self.population[start:] = [Individual(list(genes)) for genes in genomes]
+        
+    def print_stats(self):
+        if self.cache:
+            print("Fitness cache: {}".format(self.cache))
+        if self.fidelity:
+            print("Multi-fidelity: {}".format(self.fidelity))
+        if self.bounded_evaluations:
+            print("Tournaments: {} of {} opponents were abandoned early".format(self.abandoned_evaluations, self.bounded_evaluations))
+            
+    def elites(self):
+        '''Return the config_elite_count fittest individuals, leaving
+        room for at least one child.'''
+        count = min(config_elite_count, len(self.population) - 1)
+        if count <= 0:
+            return []
+        evaluated = [ind for ind in self.population if ind.fitness is not None]
+        return sorted(evaluated, key=lambda ind: ind.fitness, reverse=True)[:count]
+            
+    def evaluate(self, individuals):
+        '''Compute the phenotype and fitness of each individual,
+        reusing cached results for genomes that were seen before.
+        Individuals that already have a fitness are left alone.
+        Genomes that share a key are only evaluated once.
+        '''
+        pending = collections.OrderedDict() # Individuals to evaluate, grouped by genome key
+        for ind in individuals:
+            if ind.fitness is not None:
+                continue
+            key = self.genome_key_function(ind.genes) if self.cache else id(ind)
+            if key in pending:
+                self.cache.hits += 1
+                pending[key].append(ind)
+                continue
+            entry = self.cache.lookup(key) if self.cache else None
+            if entry is not None:
+                ind.phenotype, ind.fitness = entry
+                continue
+            pending[key] = [ind]
+        jobs = self.render_batch([group[0] for group in pending.values()])
+        results = self.map(lambda job: self.compute(*job), jobs)
+        for (key, group), (phenotype, fitness) in zip(pending.items(), results):
+            self.evaluation_count += 1
+            for ind in group:
+                ind.phenotype, ind.fitness = phenotype, fitness
+            if self.cache:
+                self.cache.store(key, phenotype, fitness)
+                
+    def render_batch(self, individuals, bounds=None):
+        '''Return a (genes, phenotype, bound, parent) job for each
+        individual. The parent is the phenotype of the individual's
+        parent if there is a delta function and it is known. The
+        phenotypes of the rest are rendered together if there is a
+        batch function, and are otherwise left as None for compute()
+        to render.'''
+        bounds = bounds or [None] * len(individuals)
+        parents = [None] * len(individuals)
+        if self.delta_function is not None:
+            parents = [ind.parent.phenotype if ind.parent else None for ind in individuals]
+        phenotypes = [None] * len(individuals)
+        full = [i for i, parent in enumerate(parents) if parent is None]
+        if self.batch_function is not None and len(full) > 1:
+            for i, phenotype in zip(full, self.batch_function([individuals[i].genes for i in full])):
+                phenotypes[i] = phenotype
+        return zip([ind.genes for ind in individuals], phenotypes, bounds, parents)
+        
+    def compute(self, genes, phenotype=None, bound=None, parent=None):
+        '''Render and score a genome, returning the phenotype and the
+        rounded fitness. With a parent phenotype, the delta function
+        is tried first, and its fitness is exact whatever the bound.
+        Otherwise, with a bound, the fitness is None if it is certain
+        to be below the bound. Runs on the worker threads in parallel
+        evaluation so it must not touch the evolver state.'''
+        if phenotype is None and parent is not None:
+            result = self.delta_function(genes, parent)
+            if result is not None:
+                phenotype, score = result
+                return phenotype, round(score, config_fitness_decimal_places)
+        if phenotype is None:
+            phenotype = self.phenotype_function(genes)
+        if bound is None:
+            score = self.fitness_function(phenotype)
+        else:
+            score = self.bounded_function(phenotype, bound)
+            if score is None:
+                return phenotype, None
+        return phenotype, round(score, config_fitness_decimal_places) # Round so we don't waste time on trivial fitness changes
+        
+    def map(self, func, items):
+        '''Apply func to each item, on the worker threads if there are any.'''
+        items = list(items)
+        if self.pool is not None and len(items) > 1:
+            return self.pool.map(func, items)
+        return map(func, items)
+            
+    def evaluate_bounded(self, contests):
+        '''Evaluate each individual of a list of (individual, bound)
+        pairs only as far as needed to tell whether it beats its bound.
+        Its fitness is left as None if it cannot.'''
+        if self.bounded_function is None:
+            return self.evaluate([ind for ind, bound in contests])
+        pending = []
+        for ind, bound in contests:
+            if ind.fitness is not None:
+                continue
+            key = self.genome_key_function(ind.genes) if self.cache else None
+            entry = self.cache.lookup(key) if self.cache else None
+            if entry is not None:
+                ind.phenotype, ind.fitness = entry
+                continue
+            pending.append((ind, bound, key))
+        jobs = self.render_batch([ind for ind, bound, key in pending], [bound for ind, bound, key in pending])
+        results = self.map(lambda job: self.compute(*job), jobs)
+        for (ind, bound, key), (phenotype, fitness) in zip(pending, results):
+            self.bounded_evaluations += 1
+            self.evaluation_count += 1
+            ind.phenotype, ind.fitness = phenotype, fitness
+            if fitness is None:
+                self.abandoned_evaluations += 1
+            elif self.cache:
+                self.cache.store(key, phenotype, fitness)
+            
+    def run_tournaments(self, individuals):
+        '''Pair the individuals off at random. The first of each pair
+        is evaluated in full and its opponent only until it can no
+        longer beat it. Return the winners ranked from worst to best.'''
+        shuffled = list(individuals)
+        random.shuffle(shuffled)
+        pairs = [(shuffled[i], shuffled[i+1]) for i in range(0, len(shuffled) - 1, 2)]
+        unpaired = shuffled[len(pairs) * 2:]
+        self.evaluate([a for a, b in pairs] + unpaired)
+        self.evaluate_bounded([(b, a.fitness) for a, b in pairs])
+        winners = [b if b.fitness is not None and b.fitter_than(a) else a for a, b in pairs] + unpaired
+        return sorted(winners, key=lambda ind: ind.fitness)
+        
+    def select_parent(self):
+        if self.cumulative_weights is None:
+            return random.choice(self.matingpool)
+        i = bisect.bisect_right(self.cumulative_weights, random.random() * self.cumulative_weights[-1])
+        return self.matingpool[i]
+            
+    def screen(self, individuals):
+        '''Evaluate individuals by successive halving. Score them at
+        each fidelity level in turn, promote the best fraction to the
+        next level, and evaluate only the finalists at full fidelity.
+        
+        Return all of the individuals ranked from worst to best. The
+        ones that were not promoted keep the rank given by their last
+        coarse score, below everyone who got further, and are left
+        with a fitness of None. Individuals that already have a
+        fitness skip the screening.
+        '''
+        ranked = []
+        evaluated = [ind for ind in individuals if ind.fitness is not None]
+        candidates = [ind for ind in individuals if ind.fitness is None]
+        for i, level in enumerate(config_fidelity_levels):
+            if not candidates:
+                break
+            scores = self.map(lambda ind: self.coarse_function(ind.genes, level), candidates)
+            for ind, score in zip(candidates, scores):
+                ind.coarse_fitness = score
+                self.evaluation_count += 1
+            candidates.sort(key=lambda ind: ind.coarse_fitness)
+            ratio = config_promotion_ratios[min(i, len(config_promotion_ratios) - 1)]
+            cut = len(candidates) - max(1, int(math.ceil(len(candidates) * ratio)))
+            ranked.extend(candidates[:cut])
+            candidates = candidates[cut:]
+        self.evaluate(candidates)
+        if candidates:
+            self.fidelity.record(candidates)
+        ranked.extend(sorted(candidates + evaluated, key=lambda ind: ind.fitness))
+        return ranked
+            
     def update_population(self):
-        for ind in self.population:
-            ind.update(self.phenotype_function, self.fitness_function)
+        if config_selection == "tournament":
+            # Only the winners are exact so they alone go into the mating pool with equal chances
+            self.matingpool = self.run_tournaments(self.population)
+            self.cumulative_weights = None
+            self.update_fittest(self.matingpool)
+            return
+        if self.fidelity:
+            ranked = self.screen(self.population)
+        else:
+            self.evaluate(self.population)
+            ranked = sorted(self.population, key=lambda ind: ind.fitness)
+        self.update_fittest(ranked)
+        # Build the mating pool of fittest individuals for the next generation.
+        # Use the rank position raised to config_rank_exponent as the mating
+        # weight and pick parents by bisecting the running total of weights.
+        self.matingpool = ranked
+        self.cumulative_weights = []
+        total = 0.0
+        for r in range(len(ranked)):
+            total += (r + 1) ** config_rank_exponent
+            self.cumulative_weights.append(total)
+            
+    def update_fittest(self, individuals):
         # Cache the fittest individual
-        for ind in self.population:
+        for ind in individuals:
+            if ind.fitness is None: continue
             if self.state.fittest is None or ind.fitter_than(self.state.fittest):
                 self.state.fittest = ind
-        # Build the mating pool of fittest individuals for the next generation
-        ranked = sorted(self.population, key=lambda ind: ind.fitness)
-        # Use the rank position squared as the mating probability
-        # Divide by the population size to more reasonable value.
-        probabilities = [int(round(((r + 1) ** 2) / float(len(self.population)))) for r in range(len(ranked))]
-        self.matingpool = []
-        for ind, prob in zip(ranked, probabilities):
-            self.matingpool.extend([ind] * prob)
         
     
 evolver = Evolver()
 
-def initialize(genome_size, phenotype_func, fitness_func):
-    evolver.initialize(genome_size, phenotype_func, fitness_func)
+def initialize(genome_size, phenotype_func, fitness_func, key_func=None, coarse_func=None, bounded_func=None, checkpoint=None, batch_func=None, delta_func=None):
+    evolver.initialize(genome_size, phenotype_func, fitness_func, key_func, coarse_func, bounded_func, checkpoint=checkpoint, batch_func=batch_func, delta_func=delta_func)
+    
+def checkpoint():
+    return evolver.checkpoint()
     
 def evolve():
     evolver.evolve()
 
 def finished():
-    return evolver.state.finished
+    return evolver.finished
     
 def fittest():
     return evolver.state.fittest
@@ -197,4 +596,13 @@ def generation_number():
 
 def stagnant_count():
     return evolver.state.stagnant_count
+
+def evaluation_count():
+    return evolver.evaluation_count
+
+def cache_stats():
+    '''Return the (hits, misses) counts of the fitness cache.'''
+    if evolver.cache is None:
+        return 0, 0
+    return evolver.cache.hits, evolver.cache.misses
         
@@ -6,8 +6,21 @@ to a set of sample images and returing a similarity score.
 
 #add_library('opencv_processing')
 #from gab.opencv import OpenCV # see https://github.com/atduskgreg/opencv-processing
+import os
+import sys
+import array
+import struct
+import hashlib
+import operator
+import bisect
+import threading
+from itertools import imap, izip
 import utils
 import settings as config
+try:
+    import numpy # Not available under Jython
+except ImportError:
+    numpy = None
 
 
 # Default settings - Don't change these here. Instead, change them in the settings.py file.
@@ -15,11 +28,17 @@ config_strictness = 4 # 1-7
 config_preprocess_mode = "gray" # "binary" or "gray" or "color"
 config_threshold = 230 # 0-255 higher value includes lighter grayscale values
 config_erode_binary = False
+config_sample_index_threshold = 16 # Index the samples per pixel when there are at least this many
+config_abandon_rows = 2 # Rows of pixels to compare between checks when a score bound is given
+config_sample_cache = True # Keep the preprocessed samples in the cache folder so they are not preprocessed again on the next start
 preview_size = 100
 
 sample_images = []
 samples = []
+sample_sources = [] # Paths of the sample images, for preprocessing at other strictness levels
+engines = {} # ScoringEngine per strictness level
 last_image = None
+last_pixels = None
 preview = False
 
 
@@ -30,19 +49,117 @@ def toggle_preview():
 
 def load_samples(sketch):
     samplespath = utils.app_data_path(sketch, "comparator_samples")
+    cache = SampleCache(sketch) if config_sample_cache else None
     for filepath in utils.listfiles(samplespath, fullpath=True):
-        img = sketch.loadImage(filepath)
-        if img is not None:
-            img, pixels = img_preprocess(sketch, img, True)
-            sample_images.append(img)
+        sample = sample_preprocess(sketch, filepath, cache, True)
+        if sample is not None:
+            w, h, pixels = sample
+            sample_sources.append(filepath)
+            sample_images.append(values_image(sketch, pixels, w, h))
             samples.append(pixels)
     if not sample_images:
         print("WARNING: image_compare could not find any sample images. Make sure you have placed in them in the folder {}".format(samplespath))
+    else:
+        engines[strictness_level()] = ScoringEngine(samples, integer_valued(sketch))
+
+
+def engine_for(sketch, strictness=None):
+    '''Return the scoring engine for the samples preprocessed at the
+    given strictness level, preprocessing them on first use.'''
+    level = strictness_level(strictness)
+    if level in engines:
+        return engines[level]
+    with lock:
+        if not samples:
+            load_samples(sketch)
+        if level not in engines:
+            cache = SampleCache(sketch) if config_sample_cache else None
+            engines[level] = ScoringEngine([sample_preprocess(sketch, filepath, cache, strictness=level)[2] for filepath in sample_sources], integer_valued(sketch))
+    return engines[level]
+
+lock = threading.RLock() # Guards sample loading and the sketch's colour caches when scoring on several threads
+
+
+def sample_preprocess(sketch, filepath, cache=None, is_sample=False, strictness=None):
+    '''Return the width, height and preprocessed pixel values of the
+    sample image in filepath, from the cache if it has them, or None
+    if the file is not an image. If is_sample, warn when the colour
+    modes are used with a sample that looks grayscale.'''
+    sample = cache.load(filepath, strictness) if cache is not None else None
+    if sample is None:
+        img = sketch.loadImage(filepath)
+        if img is None:
+            return None
+        img, pixels = img_preprocess(sketch, img, strictness=strictness)
+        sample = img.width, img.height, pixels, img_looks_grayscale(sketch, img)
+        if cache is not None:
+            cache.store(filepath, strictness, *sample)
+    w, h, pixels, grayscale = sample
+    if is_sample and grayscale:
+        print("WARNING: config_preprocess_mode is set to color but your comparator image appears to be grayscale.")
+        print("   You should change that setting to 'gray' or you will get unpredictable fitness results.")
+    return w, h, pixels
+
+
+class SampleCache(object):
+    '''Keep preprocessed samples in cache/samples in the data folder,
+    one file per sample and set of preprocessing settings. Files are
+    named after a hash of the sample file's contents, the strictness
+    level and the preprocess settings, so changing any of them just
+    selects another file, and a file that cannot be read is made
+    again. Each file holds the width and height and whether the sample
+    looks grayscale to img_looks_grayscale(), followed by the values,
+    as bytes if they are all whole numbers from 0 to 255 and as
+    doubles otherwise.
+    '''
+    magic = "ECS2"
+    header = struct.Struct("<4sIIBcI") # Magic, width, height, looks grayscale, typecode, number of values
+    
+    def __init__(self, sketch):
+        self.folder_path = os.path.join(utils.app_data_path(sketch, "cache"), "samples")
+        self.digests = {}
+        
+    def filepath(self, filepath, strictness=None):
+        if filepath not in self.digests:
+            f = open(filepath, "rb")
+            self.digests[filepath] = hashlib.md5(f.read()).hexdigest()
+            f.close()
+        settings = (self.digests[filepath], strictness_level(strictness), utils.coerce_list(config_preprocess_mode), config_threshold, config_erode_binary)
+        return os.path.join(self.folder_path, hashlib.md5(repr(settings)).hexdigest() + ".bin")
+        
+    def load(self, filepath, strictness=None):
+        '''Return the width, height, values and grayscale flag stored
+        for the sample, or None if there are none or they cannot be read.'''
+        try:
+            f = open(self.filepath(filepath, strictness), "rb")
+            data = f.read()
+            f.close()
+            magic, w, h, grayscale, typecode, count = self.header.unpack_from(data)
+            values = array.array(typecode)
+            values.fromstring(data[self.header.size:])
+        except (IOError, OSError, struct.error, ValueError, TypeError):
+            return None
+        if magic != self.magic or len(values) != count or count != w * h:
+            return None
+        if sys.byteorder == "big":
+            values.byteswap()
+        return w, h, [float(v) for v in values], bool(grayscale)
+        
+    def store(self, filepath, strictness, w, h, pixels, grayscale=False):
+        pixels = [float(v) for v in pixels]
+        typecode = "B" if all(v == int(v) and 0 <= v <= 255 for v in pixels) else "d"
+        values = array.array(typecode, [int(v) for v in pixels] if typecode == "B" else pixels)
+        if sys.byteorder == "big":
+            values.byteswap()
+        utils.create_folder(os.path.dirname(self.folder_path))
+        utils.create_folder(self.folder_path)
+        utils.save_bytes(self.filepath(filepath, strictness), self.header.pack(self.magic, w, h, int(grayscale), typecode, len(values)) + values.tostring())
 
 
 def draw_preview(sketch):
     if not preview: return
     if not sample_images: return
+    if last_image is None: return # Nothing has been compared yet
     sketch.fill(255, 150)
     sketch.rect(0, 0, sketch.width, sketch.height)
     sketch.noFill()
@@ -51,7 +168,7 @@ def draw_preview(sketch):
     w = preview_size
     h = int(w * (sketch.height / float(sketch.width)))
     sketch.tint(210, 230, 255)
-    sketch.image(last_image, x, y, w, h)
+    sketch.image(values_image(sketch, last_pixels, last_image.width, last_image.height), x, y, w, h)
     sketch.rect(x, y, w, h)
     for img in sample_images:
         x += w + margin
@@ -60,98 +177,441 @@ def draw_preview(sketch):
     sketch.noTint()
     
     
-def img_preprocess(sketch, pImg, is_sample=False):
-    img = img_resize(pImg) # Note: this will make transparent backgrounds that normally return 255 from brightness(p) return 0 instead.
-    pixels_for_modes = []
+def img_preprocess(sketch, pImg, strictness=None):
+    img = img_resize(pImg, strictness) # Note: this will make transparent backgrounds that normally return 255 from brightness(p) return 0 instead.
     modes = utils.coerce_list(config_preprocess_mode)
-    imgs = [img]
-    for i in range(len(modes)-1):
-        imgs.append(img.copy())
-    for mode, img in zip(modes, imgs):
+    for mode in modes:
+        if mode not in ("color", "hue", "gray", "binary"):
+            raise ValueError("Illegal value for config_preprocess_mode <{}>".format(config_preprocess_mode))
+    eroded = None
+    if config_erode_binary and "binary" in modes:
+        eroded = img.copy() # Erosion depends on neighbouring pixels so leave it to Processing
+        eroded.filter(sketch.ERODE)
+    pixels = fused_values(sketch, modes, img.pixels, eroded.pixels if eroded else None)
+    return img, pixels
+
+
+def fused_values(sketch, modes, argb, eroded=None):
+    '''Return the preprocessed value of each packed ARGB pixel,
+    averaged over the given modes, in a single pass.
+    
+    The values are the same as running Processing's GRAY, ERODE and
+    THRESHOLD filters on a copy of the image per mode and reading
+    each pixel with brightness(), hue() or red()/green()/blue().
+    Each distinct pixel is converted once and then looked up. If
+    eroded is given it holds the pixels for the binary mode.
+    '''
+    if numpy is not None and isinstance(argb, numpy.ndarray):
+        return _fused_array_values(sketch, modes, argb, eroded)
+    convert = _pixel_converter(sketch, modes)
+    lookup = _pixel_lookup(modes)
+    values = []
+    append = values.append
+    if eroded is None:
+        for p in argb:
+            v = lookup.get(p)
+            if v is None:
+                v = lookup[p] = convert(p, p)
+            append(v)
+    else:
+        for p, e in izip(argb, eroded):
+            key = (p, e)
+            v = lookup.get(key)
+            if v is None:
+                v = lookup[key] = convert(p, e)
+            append(v)
+    if len(lookup) > 65536:
+        lookup.clear() # Keep the lookup from growing without bound on very colourful images
+    return values
+
+
+def _fused_array_values(sketch, modes, argb, eroded=None):
+    '''Return the same values as fused_values() for pixels held in a
+    NumPy array, as they are on the raster backend, in bulk.'''
+    brightness, red, green, blue = [numpy.array(table) for table in _channel_tables(sketch)]
+    r, g, b = _channels(argb)
+    total = numpy.zeros(len(argb))
+    for mode in modes:
         if mode == "color":
-            #vals = [sketch.hue(p) for p in img.pixels]
-            vals = [utils.mean([sketch.red(p), sketch.green(p), sketch.blue(p)]) for p in img.pixels]
-            pixels_for_modes.append(vals)
-            if is_sample:
-                img_validate_color(vals)
+            total += (red[r] + green[g] + blue[b]) / 3.0
         elif mode == "hue":
-            pixels_for_modes.append([sketch.hue(p) for p in img.pixels])
-            if is_sample:
-                img_validate_color(vals)
+            total += _hue_array(r, g, b)
         elif mode == "gray":
-            img.filter(sketch.GRAY)
-            pixels_for_modes.append([sketch.brightness(p) for p in img.pixels])
+            total += brightness[(77 * r + 151 * g + 28 * b) >> 8]
         elif mode == "binary":
-            if config_erode_binary:
-                img.filter(sketch.ERODE)
-            img.filter(sketch.GRAY)
-            img.filter(sketch.THRESHOLD, config_threshold/255.0)
-            pixels_for_modes.append([sketch.brightness(p) for p in img.pixels])
-        else:
-            raise ValueError("Illegal value for config_preprocess_mode <{}>".format(config_preprocess_mode))
-    pixels = img_mean_pixel_values(pixels_for_modes)
-    return img, pixels
+            er, eg, eb = _channels(eroded) if eroded is not None else (r, g, b)
+            total += brightness[numpy.where((77 * er + 151 * eg + 28 * eb) >> 8 >= threshold_level(), 255, 0)]
+    return total / len(modes)
+
+
+def _channels(argb):
+    p = numpy.asarray(argb).astype(numpy.int64)
+    return p >> 16 & 0xFF, p >> 8 & 0xFF, p & 0xFF
+
+
+def _hue_array(r, g, b):
+    '''Return hue() of each pixel in the default colour mode, computed
+    the way java.awt.Color.RGBtoHSB does.'''
+    cmax = numpy.maximum(numpy.maximum(r, g), b).astype(numpy.float64)
+    cmin = numpy.minimum(numpy.minimum(r, g), b).astype(numpy.float64)
+    span = numpy.where(cmax > cmin, cmax - cmin, 1.0)
+    redc, greenc, bluec = (cmax - r) / span, (cmax - g) / span, (cmax - b) / span
+    hue = numpy.where(r == cmax, bluec - greenc, numpy.where(g == cmax, 2.0 + redc - bluec, 4.0 + greenc - redc)) / 6.0
+    hue = numpy.where(hue < 0, hue + 1.0, hue)
+    return numpy.where(cmax > cmin, hue, 0.0) * 255.0
+
+
+def _pixel_converter(sketch, modes):
+    '''Return a function of (pixel, binary mode pixel) that gives the
+    preprocessed value of a pixel averaged over the modes.'''
+    brightness, red, green, blue = _channel_tables(sketch)
+    threshold = threshold_level()
+    def gray(p):
+        # Same integer luminance as PImage.filter(GRAY)
+        return (77 * (p >> 16 & 0xFF) + 151 * (p >> 8 & 0xFF) + 28 * (p & 0xFF)) >> 8
+    converters = []
+    for mode in modes:
+        if mode == "color":
+            converters.append(lambda p, e: (red[p >> 16 & 0xFF] + green[p >> 8 & 0xFF] + blue[p & 0xFF]) / 3.0)
+        elif mode == "hue":
+            converters.append(lambda p, e: _hue(sketch, p))
+        elif mode == "gray":
+            converters.append(lambda p, e: brightness[gray(p)])
+        elif mode == "binary":
+            converters.append(lambda p, e: brightness[255 if gray(e) >= threshold else 0])
+    if len(converters) == 1:
+        return converters[0]
+    n = float(len(converters))
+    return lambda p, e: sum([convert(p, e) for convert in converters]) / n
+    
+
+def _channel_tables(sketch):
+    '''Return lookup tables of brightness() for gray levels and of 
+    red(), green() and blue() for channel levels, taken from the
+    sketch so that they honour its colorMode().'''
+    global channel_tables
+    with lock:
+        if channel_tables is None:
+            opaque = -0x1000000 # 0xFF000000 as a signed Java int
+            channel_tables = ([sketch.brightness(opaque | v << 16 | v << 8 | v) for v in range(256)],
+                              [sketch.red(opaque | v << 16) for v in range(256)],
+                              [sketch.green(opaque | v << 8) for v in range(256)],
+                              [sketch.blue(opaque | v) for v in range(256)])
+    return channel_tables
+
+
+def _hue(sketch, p):
+    with lock: # hue() caches its last result in the sketch
+        return sketch.hue(p)
+
+channel_tables = None
+
+
+def _pixel_lookup(modes):
+    '''Return the memo of converted pixels for the current settings.'''
+    key = (tuple(modes), config_threshold)
+    if key not in pixel_lookups:
+        with lock:
+            pixel_lookups.setdefault(key, {})
+    return pixel_lookups[key]
+
+pixel_lookups = {}
+
+
+def integer_valued(sketch):
+    '''Return True if every preprocessed value is a whole number, as it
+    is for a single gray or binary mode when brightness() gives whole
+    levels. Sums of whole numbers are exact, so only then do the sample
+    indexes give exactly the same scores as comparing each sample.'''
+    modes = utils.coerce_list(config_preprocess_mode)
+    if len(modes) != 1 or modes[0] not in ("gray", "binary"):
+        return False
+    return all(float(v).is_integer() for v in _channel_tables(sketch)[0])
+
+
+def threshold_level():
+    '''Return the level that PImage.filter(THRESHOLD, config_threshold/255.0)
+    compares against, reproducing its single-precision arithmetic.'''
+    param = utils.to_float32(config_threshold / 255.0)
+    return int(utils.to_float32(param * 255))
+
+
+def values_image(sketch, values, w, h):
+    '''Return a grayscale image of preprocessed pixel values for previewing.'''
+    img = sketch.createImage(w, h, sketch.RGB)
+    img.loadPixels()
+    for i, v in enumerate(values):
+        g = utils.constrain(int(round(v)), 0, 255)
+        img.pixels[i] = -0x1000000 | g << 16 | g << 8 | g
+    img.updatePixels()
+    return img
     
 
-def img_resize(pImg):
-    sizes = [5, 9, 15, 25, 50, 100, 200]
-    i = utils.constrain(int(round(config_strictness)), 1, len(sizes)) - 1
+def img_resize(pImg, strictness=None):
+    size = comparison_size(strictness)
+    if max(pImg.width, pImg.height) == size:
+        return pImg # Already rendered at comparator resolution
     img = pImg.copy()
     if img.width > img.height:
-        img.resize(sizes[i], 0)
+        img.resize(size, 0)
     else:
-        img.resize(0, sizes[i])
+        img.resize(0, size)
     return img
-    
-    
-def img_validate_color(pixels):
-    mean = sum(pixels) / len(pixels)
-    isgrayscale = sum(1 if p == mean else 0 for p in pixels)
-    if isgrayscale:
-        print("WARNING: config_preprocess_mode is set to color but your comparator image appears to be grayscale.")
-        print("   You should change that setting to 'gray' or you will get unpredictable fitness results.")
 
 
-def img_mean_pixel_values(pixels_for_modes):
-    if len(pixels_for_modes) > 1:
-        return [sum(p) / float(len(p)) for p in zip(*pixels_for_modes)] # Average the pixel values across modes
+comparison_sizes = [5, 9, 15, 25, 50, 100, 200] # Longest side of compared images for each strictness level
+
+
+def strictness_level(strictness=None):
+    '''Return the strictness as a valid level, defaulting to config_strictness.'''
+    if strictness is None:
+        strictness = config_strictness
+    return utils.constrain(int(round(strictness)), 1, len(comparison_sizes))
+
+
+def comparison_size(strictness=None):
+    '''Return the length of the longest side of the images that are compared.'''
+    return comparison_sizes[strictness_level(strictness) - 1]
+
+
+def evaluation_size(width, height, strictness=None):
+    '''Return the dimensions that an image of the given size will
+    have after img_resize(), so drawings can be rendered directly
+    at comparator resolution.
+    '''
+    size = comparison_size(strictness)
+    if width > height:
+        return size, int(height * size / float(width))
     else:
-        return list(pixels_for_modes[0])
+        return int(width * size / float(height)), size
+    
     
+def img_looks_grayscale(sketch, img):
+    '''Return True if a colour mode is in config_preprocess_mode and
+    the image's values in that mode look grayscale.'''
+    for mode in utils.coerce_list(config_preprocess_mode):
+        if mode in ("color", "hue"):
+            pixels = fused_values(sketch, [mode], img.pixels)
+            mean = sum(pixels) / len(pixels)
+            if any(p == mean for p in pixels):
+                return True
+    return False
 
-def compare(sketch, pImg):
+
+def compare(sketch, pImg, strictness=None, bound=None):
     ''' Compare an image to the set of sample images.
     
     This is the main public method of the comparator.
-    Handles just-in-time initialization.
+    Handles just-in-time initialization. Pass a strictness
+    level to get a cheaper or more accurate score than the
+    one given by config_strictness. If a bound is given,
+    the comparison stops and returns None as soon as the
+    score is certain to end up below the bound.
     '''
-    if not samples:
-        load_samples(sketch)
-    validate_aspect_ratio(pImg)
-    global last_image # Remember it so we can draw a preview if desired
-    last_image, imgpixels = img_preprocess(sketch, pImg)
-    overall_score = 0.0
-    for samplepixels in samples:
-        score = 0.0
-        for i, p in enumerate(imgpixels):
-            score += 1.0 - (abs(samplepixels[i] - imgpixels[i]) / 255.0)
-        score /= len(imgpixels) # Mean error for all pixel comparisions for this sample
-        overall_score += score
-    overall_score /= len(samples) # Mean error for all sample comparisons
-    return overall_score
-
-def validate_aspect_ratio(pImg):
-    imgaspectratio = round(float(pImg.width) / pImg.height, 3)
-    comparatoraspectratio = round(float(sample_images[0].width) / sample_images[0].height, 3)
-    if imgaspectratio != comparatoraspectratio:
-        print imgaspectratio, comparatoraspectratio
+    engine = engine_for(sketch, strictness)
+    timer = utils.profiler.start()
+    img, pixels = img_preprocess(sketch, pImg, strictness=strictness)
+    utils.profiler.stop("preprocess", timer)
+    if len(pixels) != engine.pixel_count:
         raise ValueError("Comparator image and generated image must be the same aspect ratio.")
+    if strictness_level(strictness) == strictness_level():
+        remember_preview(img, pixels)
+    timer = utils.profiler.start()
+    pixels = engine.candidate(pixels)
+    if bound is not None:
+        score = engine.bounded_score(pixels, bound, img.width * config_abandon_rows)
+    else:
+        score = engine.score(pixels)
+    utils.profiler.stop("compare", timer)
+    return score
+
+
+def remember_preview(img, pixels):
+    '''Keep the last compared image and its preprocessed pixels so that
+    draw_preview() can show them.'''
+    global last_image, last_pixels
+    last_image, last_pixels = img, pixels
+    
+
+class ScoringEngine(object):
+    '''Score preprocessed images against the preprocessed samples.
+    
+    The score is the mean over all samples and pixels of 
+    1 - |sample - image| / 255. That is the same as one minus the
+    summed absolute difference divided by its maximum, which lets
+    each sample be compared in a single bulk pass over compact
+    primitive arrays instead of a Python loop per pixel. With NumPy
+    the samples are compared all at once as a matrix.
+    
+    The sample indexes are used only if integer_values is True, 
+    meaning that samples and images hold whole numbers only.
+    '''
+    def __init__(self, samples, integer_values=False):
+        self.samples = [utils.primitive_array('d', s) for s in samples]
+        self.pixel_count = len(samples[0])
+        self.matrix = None
+        self.index = None
+        if integer_values and len(samples) > 2 and all(v in (0.0, 255.0) for s in samples for v in s):
+            self.index = BinarySampleIndex(samples)
+        elif numpy is not None:
+            self.matrix = numpy.array(samples, dtype=numpy.float64) # Faster than the sorted index
+        elif integer_values and len(samples) >= config_sample_index_threshold:
+            self.index = SortedSampleIndex(samples)
+        
+    def candidate(self, pixels):
+        '''Return preprocessed pixels in the form that the engine compares
+        fastest: a NumPy array with NumPy, a Java double[] like the
+        samples under Jython. Under CPython without NumPy an array.array
+        is no faster to iterate than a list, so lists are left as they are.'''
+        if numpy is not None:
+            return numpy.asarray(pixels, dtype=numpy.float64)
+        if utils.jarray is not None:
+            return utils.primitive_array('d', pixels)
+        return pixels
+        
+    def total_difference(self, pixels, start=0, stop=None):
+        '''Return the absolute pixel differences summed over all samples,
+        optionally for the pixels from start up to stop only.'''
+        if stop is None:
+            stop = len(pixels)
+        if self.matrix is not None:
+            return float(numpy.abs(self.matrix[:, start:stop] - numpy.asarray(pixels[start:stop], dtype=numpy.float64)).sum())
+        if self.index is not None:
+            return self.index.total_difference(pixels, start, stop)
+        if start > 0 or stop < len(pixels):
+            pixels = pixels[start:stop]
+            return sum(abs_difference(s[start:stop], pixels) for s in self.samples)
+        return sum(abs_difference(s, pixels) for s in self.samples)
+        
+    def pixel_difference(self, indices, values):
+        '''Return the absolute differences between the samples and the
+        values of the pixels at the given indices, summed over all
+        samples.'''
+        if self.matrix is not None:
+            return float(numpy.abs(self.matrix[:, indices] - numpy.asarray(values, dtype=numpy.float64)).sum())
+        return sum(abs(s[i] - v) for s in self.samples for i, v in izip(indices, values))
+        
+    def pixel_errors(self, indices, values):
+        '''Return the absolute difference between the samples and the
+        value of each pixel at the given indices, summed over all
+        samples, one pixel at a time.'''
+        if self.matrix is not None:
+            return numpy.abs(self.matrix[:, indices] - numpy.asarray(values, dtype=numpy.float64)).sum(axis=0)
+        if self.index is not None:
+            return self.index.pixel_errors(indices, values)
+        return [sum(abs(s[i] - v) for s in self.samples) for i, v in izip(indices, values)]
+        
+    def score(self, pixels):
+        maxdiff = 255.0 * len(pixels) * len(self.samples)
+        return 1.0 - self.total_difference(pixels) / maxdiff
+        
+    def bounded_score(self, pixels, bound, block):
+        '''Return the score, or None as soon as it is certain to be
+        below the bound. Pixels are compared block pixels at a time,
+        and the best score still possible after each block assumes
+        that all the remaining pixels match perfectly.'''
+        maxdiff = 255.0 * len(pixels) * len(self.samples)
+        limit = (1.0 - bound) * maxdiff # Largest difference that still reaches the bound
+        if numpy is not None:
+            pixels = numpy.asarray(pixels, dtype=numpy.float64) # Convert once rather than per block
+        total = 0.0
+        for start in range(0, len(pixels), max(1, block)):
+            total += self.total_difference(pixels, start, start + block)
+            if total > limit:
+                return None
+        return 1.0 - total / maxdiff
+
+
+class SortedSampleIndex(object):
+    '''Per-pixel index of the sample values that makes the summed
+    difference to all k samples cost a binary search per pixel
+    rather than k subtractions.
+    
+    At each pixel the sample values are kept sorted, together with
+    their prefix sums. If c of the k values are <= x and those sum
+    to below, the summed absolute difference to x is
+    x * c - below + (total - below) - x * (k - c).
+    '''
+    def __init__(self, samples):
+        self.k = len(samples)
+        values = []
+        prefix = []
+        for column in zip(*samples):
+            column = sorted(column)
+            values.extend(column)
+            total = 0.0
+            prefix.append(total)
+            for v in column:
+                total += v
+                prefix.append(total)
+        self.values = utils.primitive_array('d', values)
+        self.prefix = utils.primitive_array('d', prefix)
+        
+    def total_difference(self, pixels, start=0, stop=None):
+        stop = len(pixels) if stop is None else min(stop, len(pixels))
+        return sum(self.differences(xrange(start, stop), pixels[start:stop]))
+
+    def pixel_errors(self, indices, values):
+        '''Return the summed difference to the samples of each pixel
+        at the given indices, with the same lookup as total_difference().'''
+        return list(self.differences(indices, values))
+
+    def differences(self, indices, values):
+        '''Yield the summed difference to the samples of each value at
+        the pixel index it is paired with.'''
+        k, sorted_values, prefix = self.k, self.values, self.prefix
+        for i, x in izip(indices, values):
+            lo = i * k
+            c = bisect.bisect_right(sorted_values, x, lo, lo + k) - lo
+            p = i * (k + 1)
+            below = prefix[p + c]
+            yield x * c - below + (prefix[p + k] - below) - x * (k - c)
+
+
+class BinarySampleIndex(object):
+    '''Index for samples that are pure black (0) or white (255).
+    
+    If c of the k samples are white at a pixel, the summed absolute 
+    difference to x is (k - c) * x + c * (255 - x). Summed over all
+    pixels that is k * sum(x) + 255 * sum(c) - 2 * sum(c * x), which
+    takes two bulk passes however many samples there are.
+    '''
+    def __init__(self, samples):
+        self.k = len(samples)
+        self.counts = utils.primitive_array('d', [float(sum(1 for v in column if v)) for column in zip(*samples)])
+        self.count_total = sum(self.counts)
+        if numpy is not None:
+            self.counts = numpy.array(self.counts)
+        
+    def total_difference(self, pixels, start=0, stop=None):
+        if numpy is not None:
+            pixels = numpy.asarray(pixels[start:stop], dtype=numpy.float64)
+            counts = self.counts[start:stop]
+            return self.k * pixels.sum() + 255.0 * counts.sum() - 2.0 * float(numpy.dot(counts, pixels))
+        counts, count_total = self.counts, self.count_total
+        if start > 0 or (stop is not None and stop < len(pixels)):
+            pixels = pixels[start:stop]
+            counts = counts[start:stop]
+            count_total = sum(counts)
+        return self.k * sum(pixels) + 255.0 * count_total - 2.0 * sum(imap(operator.mul, counts, pixels))
+
+    def pixel_errors(self, indices, values):
+        '''Return the summed difference to the samples of each pixel
+        at the given indices, (k - c) * x + c * (255 - x).'''
+        k, counts = self.k, self.counts
+        return [(k - counts[i]) * x + counts[i] * (255.0 - x) for i, x in izip(indices, values)]
+
+
+def abs_difference(px1, px2):
+    '''Return the sum of the absolute differences of two pixel sequences,
+    in one NumPy operation if NumPy is available.'''
+    if numpy is not None:
+        return float(numpy.abs(numpy.asarray(px1, dtype=numpy.float64) - numpy.asarray(px2, dtype=numpy.float64)).sum())
+    return sum(imap(abs, imap(operator.sub, px1, px2)))
+
 
 def pixel_score(px1, px2):
-    score = 0
-    for i in range(len(px1)):
-        score += 1.0 - (abs(px1[i] - px2[i]) / 255.0)
-    return score / float(len(px1))
+    return 1.0 - abs_difference(px1, px2) / (255.0 * len(px1))
     
     
 def to_rgb(sketch, px):
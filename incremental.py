@@ -0,0 +1,195 @@
+"""
+This module renders and scores the children of the genetic algorithm
+by updating the drawing of one of their parents, when
+drawing.config_incremental_rendering is set.
+
+A child usually differs from the parent it takes most of its genes
+from in only a part or two. The box of pixels that each part can
+reach follows from its size, position and angle, so only the boxes
+of the parts that changed, where they were and where they are now,
+need to be drawn again. The child's drawing starts as a copy of the
+parent's, those boxes are cleared and every part that reaches them
+is drawn again in drawing order, and the comparator's difference to
+the samples is worked out again only for the pixels inside them.
+Children that would need more than config_max_dirty_fraction of the
+canvas drawing again are rendered in full.
+
+Drawings rendered in full are scored in one bulk pass like any other.
+Their difference at each pixel is worked out only once one of them
+becomes a parent.
+
+"""
+import threading
+from itertools import izip
+import utils
+import drawing
+import image_comparator as ic
+try:
+    import numpy # Not available under Jython
+except ImportError:
+    numpy = None
+
+
+# Settings
+config_max_dirty_fraction = 0.5 # Render children in full when the boxes to draw again cover more of the canvas than this
+
+
+class Evaluation(object):
+    '''A drawing at comparator resolution together with what is needed
+    to update it for a child.'''
+
+    def __init__(self, image, keys, boxes, values, total, errors=None):
+        self.image = image # Copy of the canvas
+        self.keys = keys # What each part resolves to, from drawing.genome_key()
+        self.boxes = boxes # Pixels each part can reach and its drawing order, from drawing.part_boxes()
+        self.values = values # Preprocessed value of each pixel
+        self.total = total # Difference to the samples summed over all pixels and samples
+        self.errors = errors # Difference to the samples at each pixel, summed over the samples, or None until needed
+
+
+class IncrementalEvaluator(object):
+    '''Render and score drawings of the given size, in full or by
+    updating the evaluation of a parent.'''
+
+    def __init__(self, sketch, width, height):
+        self.sketch = sketch
+        self.width = width
+        self.height = height
+        self.engine = ic.engine_for(sketch)
+        if width * height != self.engine.pixel_count:
+            raise ValueError("Comparator image and generated image must be the same aspect ratio.")
+        self.modes = utils.coerce_list(ic.config_preprocess_mode)
+        self.lock = threading.Lock()
+        self.full_renders = 0
+        self.updates = 0
+        self.fallbacks = 0
+        self.dirty_pixels = 0
+
+    def canvas(self):
+        return utils.GraphicsBuffer(self.sketch.createGraphics, self.width, self.height)
+
+    def render(self, params):
+        '''Render the drawing for the genome in full and return its evaluation.'''
+        canvas = self.canvas()
+        canvas.beginDraw()
+        drawing.render(self.sketch, params, canvas)
+        canvas.endDraw()
+        image = canvas.get()
+        values = ic.fused_values(self.sketch, self.modes, image.pixels)
+        total = self.engine.total_difference(values)
+        with self.lock:
+            self.full_renders += 1
+        return Evaluation(image, drawing.genome_key(self.sketch, params), drawing.part_boxes(self.sketch, params, canvas), values, total)
+
+    def score(self, evaluation):
+        '''Return the comparator score of an evaluation.'''
+        ic.remember_preview(evaluation.image, evaluation.values)
+        return 1.0 - evaluation.total / (255.0 * self.engine.pixel_count * len(self.engine.samples))
+
+    def errors(self, evaluation):
+        '''Return the difference to the samples at each pixel of an
+        evaluation, working it out on first use.'''
+        if evaluation.errors is None:
+            evaluation.errors = self.engine.pixel_errors(range(self.width * self.height), evaluation.values) # Threads may both do this, to the same result
+        return evaluation.errors
+
+    def update(self, params, parent):
+        '''Return the evaluation and score of the drawing for the genome,
+        worked out from the evaluation of a parent, or None if too much
+        of the drawing differs for that to be worth doing.'''
+        keys = drawing.genome_key(self.sketch, params)
+        if len(keys) != len(parent.keys):
+            return None
+        canvas = self.canvas()
+        boxes = drawing.part_boxes(self.sketch, params, canvas)
+        dirty = []
+        for i, (key, parent_key) in enumerate(zip(keys, parent.keys)):
+            if key != parent_key:
+                dirty.extend(box for box in (parent.boxes[0][i], boxes[0][i]) if box)
+        regions = merge_boxes(dirty)
+        area = sum((right - left) * (bottom - top) for left, top, right, bottom in regions)
+        if area > config_max_dirty_fraction * self.width * self.height:
+            with self.lock:
+                self.fallbacks += 1
+            return None
+        image, values, errors = parent.image, parent.values, self.errors(parent)
+        if regions:
+            canvas.beginDraw()
+            canvas.image(parent.image, 0, 0)
+            drawing.render_regions(self.sketch, params, canvas, regions, boxes)
+            canvas.endDraw()
+            image = canvas.get()
+            indices = [y * self.width + x for left, top, right, bottom in regions for y in range(top, bottom) for x in range(left, right)]
+            pixels = image.pixels
+            if numpy is not None and isinstance(pixels, numpy.ndarray):
+                argb = pixels[indices]
+            else:
+                argb = [pixels[i] for i in indices]
+            changed = ic.fused_values(self.sketch, self.modes, argb)
+            values = patch(parent.values, indices, changed)
+            errors = patch(errors, indices, self.engine.pixel_errors(indices, changed))
+        with self.lock:
+            self.updates += 1
+            self.dirty_pixels += area
+        total = float(errors.sum()) if numpy is not None and isinstance(errors, numpy.ndarray) else sum(errors)
+        evaluation = Evaluation(image, keys, boxes, values, total, errors)
+        return evaluation, self.score(evaluation)
+
+    def __str__(self):
+        dirty = self.dirty_pixels / float(self.updates * self.width * self.height) if self.updates else 0.0
+        return "Incremental rendering: {} updates drawing {:.1%} of the canvas on average, {} full renders, {} of them for children that changed too much.".format(
+            self.updates, dirty, self.full_renders, self.fallbacks)
+
+
+def merge_boxes(boxes):
+    '''Return boxes (left, top, right, bottom) that cover the given ones
+    without overlapping, by replacing boxes that overlap with the box
+    around both until none do.'''
+    merged = []
+    for box in boxes:
+        i = 0
+        while i < len(merged):
+            if drawing.overlaps(merged[i], box):
+                other = merged.pop(i)
+                box = (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3]))
+                i = 0
+            else:
+                i += 1
+        merged.append(box)
+    return merged
+
+
+def patch(values, indices, changed):
+    '''Return a copy of values with the items at indices replaced by changed.'''
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        values = values.copy()
+        values[indices] = changed
+        return values
+    values = list(values)
+    for i, v in izip(indices, changed):
+        values[i] = v
+    return values
+
+
+def unsupported(sketch):
+    '''Return why incremental rendering cannot be used with the current settings, or None if it can.'''
+    if drawing.config_rotation_jitter:
+        return "rotation jitter depends on the whole genome"
+    if hasattr(drawing, "draw_background"):
+        return "the background module may draw differently for each genome"
+    if ic.config_erode_binary and "binary" in utils.coerce_list(ic.config_preprocess_mode):
+        return "erosion mixes neighbouring pixels"
+    return None
+
+
+def create(sketch, width, height):
+    '''Return an evaluator for drawings of the given size, or None if
+    incremental rendering is not enabled or cannot be used with the
+    current settings.'''
+    if not drawing.config_incremental_rendering:
+        return None
+    reason = unsupported(sketch)
+    if reason is not None:
+        print("WARNING: Rendering every drawing in full because incremental rendering cannot be used: {}.".format(reason))
+        return None
+    return IncrementalEvaluator(sketch, width, height)
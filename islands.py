@@ -0,0 +1,239 @@
+"""
+This module runs the solver as one island of an island model.
+Several copies of the sketch, each in its own process, evolve
+their own populations side by side and periodically send their
+fittest genomes to each other through a shared migration folder.
+
+To use it, set config_island_count and start the sketch that
+many times. Each copy claims the first free island. Point
+config_migration_dir at a shared network folder to spread the
+islands across machines.
+
+"""
+import os
+import time
+import random
+import utils
+
+
+# Settings
+config_island_count = 1 # Number of islands. Set to 1 to disable the island model.
+config_migration_interval = 25 # Generations between migrations
+config_migrant_count = 2 # Number of fittest genomes each island sends per migration
+config_topology = "ring" # "ring" sends migrants to the next island, "all" to every other island, "random" to one other island
+config_migration_dir = None # Folder shared by the islands. Leave at None to use the islands folder in the data folder.
+config_stale_seconds = 600 # An island that has not reported for this long, or for three of its generations if longer, is assumed to have died and can be taken over
+verbose = False
+
+island = None
+
+
+class Island(object):
+    """
+    One island of the island model. Every migration it writes its
+    status and migrants to island-N.pkl in the migration folder and
+    reads the files of the other islands. Files are replaced by an
+    atomic rename so that a half-written file is never read. Every
+    generation it also refreshes island-N.alive, so that the others
+    can tell it is still running between migrations.
+    """
+
+    def __init__(self, path, count):
+        self.path = path
+        self.count = count
+        self.rng = random.Random() # Keep topology choices out of the solver's random sequence
+        self.joined = time.time()
+        self.last_received = {}
+        self.others = {}
+        self.reported_finished = False
+        self.sent = 0
+        self.received = 0
+        self.last_heartbeat = 0
+        self.last_generation = time.time()
+        self.generation_seconds = 0.0 # Longest generation so far
+        utils.create_folder(path)
+        self.index = self.claim()
+        self.publish(None, [], False)
+        self.heartbeat()
+
+    def claim(self):
+        '''Claim the first island that is free or whose owner stopped
+        reporting, by creating its lock folder. Creating a folder is
+        atomic so two processes can never claim the same island.'''
+        for i in range(self.count):
+            lock = self.filepath(i, ".lock")
+            if self.is_stale(i):
+                try:
+                    os.rmdir(lock)
+                except OSError:
+                    pass
+            try:
+                os.mkdir(lock)
+            except OSError:
+                continue
+            self.lock = lock
+            return i
+        raise RuntimeError("All {} islands in <{}> are taken. Increase config_island_count or stop another copy of the sketch.".format(self.count, self.path))
+
+    def is_stale(self, i):
+        '''Return True if none of the files of island i has been touched
+        for config_stale_seconds, or for three of its longest generations
+        if that is longer. Ages are measured against the clock of the
+        migration folder's storage, not this machine's.'''
+        paths = [p for p in (self.filepath(i, ".lock"), self.filepath(i, ".pkl"), self.filepath(i, ".alive")) if os.path.exists(p)]
+        if not paths:
+            return False
+        try:
+            generation_seconds = utils.load_object(self.filepath(i, ".alive"))["generation_seconds"]
+        except Exception:
+            generation_seconds = 0.0 # No heartbeat yet, or the file is being replaced
+        limit = max(config_stale_seconds, 3 * generation_seconds)
+        return self.storage_time() - max(os.path.getmtime(p) for p in paths) > limit
+
+    def storage_time(self):
+        '''Return the current time according to the storage that holds
+        the migration folder, by writing a file and reading back its
+        modification time. On shared storage file times are set by the
+        file server, so this keeps the ages of other islands' files
+        right even if the machines' clocks disagree.'''
+        path = os.path.join(self.path, "clock")
+        try:
+            f = open(path, 'wb')
+            f.write(str(time.time()))
+            f.close()
+            return os.path.getmtime(path)
+        except (IOError, OSError):
+            return time.time() # Another process has it open
+
+    def heartbeat(self):
+        '''Rewrite this island's heartbeat file with the length of its
+        longest generation so far. Called every generation, but writes
+        at most every tenth of config_stale_seconds.'''
+        now = time.time()
+        self.generation_seconds = max(self.generation_seconds, now - self.last_generation)
+        self.last_generation = now
+        if now - self.last_heartbeat < config_stale_seconds / 10.0: return
+        self.last_heartbeat = now
+        utils.save_object(self.filepath(self.index, ".alive"), {"time": now, "generation_seconds": self.generation_seconds})
+
+    def filepath(self, i, extension):
+        return os.path.join(self.path, "island-{}{}".format(i, extension))
+
+    def targets(self):
+        others = [i for i in range(self.count) if i != self.index]
+        if config_topology == "ring":
+            return [(self.index + 1) % self.count]
+        if config_topology == "all":
+            return others
+        if config_topology == "random":
+            return [self.rng.choice(others)]
+        raise ValueError("Unknown island topology: {}".format(config_topology))
+
+    def publish(self, evolver, migrants, finished):
+        status = {
+            "index": self.index,
+            "time": time.time(),
+            "generation": evolver.state.generation_number if evolver else 0,
+            "high_score": evolver.state.high_score if evolver else None,
+            "finished": finished,
+            "targets": self.targets(),
+            "migrants": [ind.genes for ind in migrants],
+            }
+        utils.save_object(self.filepath(self.index, ".pkl"), status)
+        self.status = status
+        self.reported_finished = finished
+        self.sent += len(migrants)
+
+    def read(self):
+        '''Read the status of the other islands and return the genomes
+        they have sent to this island since the last read.'''
+        genomes = []
+        for i in range(self.count):
+            if i == self.index: continue
+            try:
+                status = utils.load_object(self.filepath(i, ".pkl"))
+            except Exception:
+                continue # Not started yet, or the file is being replaced
+            self.others[i] = status
+            if status["time"] <= max(self.last_received.get(i, 0), self.joined): continue
+            self.last_received[i] = status["time"]
+            if self.index in status["targets"]:
+                genomes.extend(status["migrants"])
+        return genomes
+
+    def exchange(self, evolver):
+        '''Send the fittest individuals of the last generation and
+        put the genomes received from other islands in place of the
+        last children of the new generation. Called by the evolver
+        once per generation, before the new generation is evaluated.'''
+        self.heartbeat()
+        finished = evolver.state.finished
+        if evolver.state.generation_number % config_migration_interval == 0 or finished != self.reported_finished:
+            self.publish(evolver, self.emigrants(evolver), finished)
+            genomes = self.read()[:len(evolver.population) - len(evolver.elites())]
+            if genomes:
+                evolver.immigrate(genomes)
+                self.received += len(genomes)
+                if verbose:
+                    print("Island {} received {} migrants".format(self.index, len(genomes)))
+            if verbose:
+                print(self)
+
+    def emigrants(self, evolver):
+        candidates = [evolver.state.fittest] + list(reversed(evolver.matingpool))
+        migrants = []
+        for ind in candidates:
+            if len(migrants) >= config_migrant_count: break
+            if ind is None or ind.fitness is None: continue
+            if any(ind.genes == other.genes for other in migrants): continue
+            migrants.append(ind)
+        return migrants
+
+    def all_finished(self):
+        '''Return True if every other island has reported that it
+        stagnated, or has stopped reporting altogether.'''
+        for i in range(self.count):
+            if i == self.index: continue
+            status = self.others.get(i)
+            if status is None or status["time"] < self.joined:
+                continue # Has not reported since this island joined, so is not running
+            if not status["finished"] and not self.is_stale(i):
+                return False
+        return True
+
+    def leave(self):
+        '''Report this island as finished, since it no longer holds
+        the others up, and release its lock.'''
+        status = dict(self.status, time=time.time(), finished=True, migrants=[])
+        utils.save_object(self.filepath(self.index, ".pkl"), status)
+        self.status = status
+        try:
+            os.rmdir(self.lock)
+        except OSError:
+            pass
+
+    def __str__(self):
+        scores = []
+        for i in range(self.count):
+            status = self.status if i == self.index else self.others.get(i, {})
+            scores.append("{}{}{}".format("*" if i == self.index else "", status.get("high_score"), " (done)" if status.get("finished") else ""))
+        return "Island {} of {}: sent {} and received {} migrants. Fittest per island: {}".format(
+            self.index, self.count, self.sent, self.received, ", ".join(scores))
+
+
+def join(sketch, ga):
+    '''Claim an island and connect it to the solver, if the island
+    model is enabled. Return the island or None.'''
+    global island
+    if config_island_count < 2: return None
+    path = config_migration_dir or utils.app_data_path(sketch, "islands")
+    island = Island(path, config_island_count)
+    ga.evolver.island = island
+    print("Joined as island {} of {} in <{}>.".format(island.index, island.count, path))
+    return island
+
+
+def leave():
+    if island is not None:
+        island.leave()
+        print(island)
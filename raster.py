@@ -0,0 +1,583 @@
+"""
+This module provides a headless raster backend for running the
+drawing and image comparator modules without Processing, e.g. under
+CPython 2.7 on a server or in worker processes. Like the rest of the
+sketch it is written for Python 2 and does not run under Python 3.
+It implements the small part of the Processing API that those
+modules use on NumPy arrays.
+
+Usage:
+
+sketch = raster.Sketch(400, 400, "/path/to/sketch/data")
+drawing.initialize()
+img = drawing.render_offscreen(sketch, genes, 25, 25)
+score = image_comparator.compare(sketch, img)
+
+Pixels are packed ARGB values in a flat int32 array, the same
+layout as a Processing pixels[] array. Drawing follows Processing's
+Java2D renderer: image() truncates its rectangle to whole pixels,
+samples bicubically and blends by alpha, and resize() halves the
+image bilinearly until it reaches the new size. To check the
+backend against Processing, set app.record_raster_reference in
+settings.py and run the sketch once in Processing, which saves
+data/raster_reference.pkl, then run
+
+python2.7 raster.py data/raster_reference.pkl
+
+benchmarks/raster_reference holds a reference recorded this way with
+its parts. The draw calls were replayed in the Java2D renderer of
+Processing 4's core.jar, resizing with the AWT code that Processing 3
+uses for every image. The validation tolerances below are the worst
+differences measured against it and against a PointLayout run at
+200x200: at most 0.06% of pixels differ by more than 4, all of them
+along the edges of rotated parts.
+
+Images are read and written as 8-bit PNG files.
+
+"""
+import os
+import sys
+import math
+import zlib
+import struct
+import colorsys
+try:
+    import numpy # Not available under Jython
+except ImportError:
+    numpy = None
+
+
+# Settings
+config_validation_tolerance = 4 # Largest difference per channel (0-255) at which a pixel still matches Processing
+config_validation_max_mismatch = 0.002 # Fraction of pixels that may differ by more than the tolerance
+
+
+# Processing builtins that the modules call
+radians = math.radians
+sqrt = math.sqrt
+
+def color(r, g=None, b=None, a=255):
+    if g is None:
+        g = b = r
+    return _signed((int(a) & 0xFF) << 24 | (int(r) & 0xFF) << 16 | (int(g) & 0xFF) << 8 | (int(b) & 0xFF))
+
+
+def _signed(value):
+    '''Return a packed ARGB value as a signed 32-bit int, as Java stores it.'''
+    return value - (1 << 32) if value & 0x80000000 else value
+
+
+def unpack(pixels):
+    '''Return packed ARGB pixels as an array of float RGBA channels.'''
+    p = numpy.asarray(pixels).astype(numpy.uint32)
+    return numpy.stack([p >> 16 & 0xFF, p >> 8 & 0xFF, p & 0xFF, p >> 24], axis=-1).astype(numpy.float64)
+
+
+def pack(rgba):
+    '''Return float RGBA channels as packed ARGB pixels.'''
+    c = numpy.clip(numpy.rint(rgba), 0, 255).astype(numpy.uint32)
+    return (c[..., 3] << 24 | c[..., 0] << 16 | c[..., 1] << 8 | c[..., 2]).view(numpy.int32)
+
+
+def premultiply(rgba):
+    out = rgba.copy()
+    out[..., :3] *= rgba[..., 3:] / 255.0
+    return out
+
+
+def unpremultiply(rgba):
+    out = rgba.copy()
+    alpha = rgba[..., 3:]
+    out[..., :3] = numpy.where(alpha > 0, rgba[..., :3] * 255.0 / numpy.maximum(alpha, 1e-9), 0.0)
+    return out
+
+
+class Image(object):
+    '''An image with a Processing style pixels[] array. Call
+    updatePixels() after changing pixels[] directly.
+    
+    While it is drawn on, an image is kept as float channels with
+    premultiplied alpha, and only packed into pixels[] again when
+    they are asked for.'''
+
+    def __init__(self, width, height, pixels=None):
+        if numpy is None:
+            raise ImportError("The raster backend needs NumPy, which is not available under Jython.")
+        self.width = int(width)
+        self.height = int(height)
+        if pixels is None:
+            self._pixels = numpy.zeros(self.width * self.height, dtype=numpy.int32)
+        else:
+            self._pixels = numpy.array(pixels, dtype=numpy.int64).astype(numpy.int32).reshape(-1)
+        self._premultiplied = None
+
+    @property
+    def pixels(self):
+        if self._pixels is None:
+            self._pixels = pack(unpremultiply(self._premultiplied)).reshape(-1)
+        return self._pixels
+
+    @pixels.setter
+    def pixels(self, values):
+        self._pixels = values
+        self._premultiplied = None
+
+    def loadPixels(self):
+        pass
+
+    def updatePixels(self):
+        self.pixels = self.pixels # Drop the channels so they are unpacked from the changed pixels
+
+    def premultiplied(self):
+        '''Return the channels with premultiplied alpha, as drawn by image().'''
+        if self._premultiplied is None:
+            self._premultiplied = premultiply(unpack(self.pixels).reshape(self.height, self.width, 4))
+        return self._premultiplied
+
+    def set_premultiplied(self, rgba):
+        self.height, self.width = rgba.shape[:2]
+        self._premultiplied = rgba
+        self._pixels = None
+
+    def copy(self):
+        return Image(self.width, self.height, self.pixels)
+
+    def get(self):
+        return self.copy()
+
+    def resize(self, w, h):
+        '''Resize in place, keeping the aspect ratio if w or h is 0.'''
+        if w == 0:
+            w = self.width * h / float(self.height)
+        if h == 0:
+            h = self.height * w / float(self.width)
+        w, h = max(1, int(w)), max(1, int(h))
+        src = self.premultiplied()
+        rows = resampling_matrix(self.height, h)
+        cols = resampling_matrix(self.width, w)
+        resized = numpy.tensordot(rows.dot(src.reshape(self.height, -1)).reshape(h, self.width, 4), cols, axes=([1], [1]))
+        self.set_premultiplied(resized.transpose(0, 2, 1).copy())
+
+    def filter(self, kind, param=None):
+        rgba = unpack(self.pixels).reshape(self.height, self.width, 4)
+        gray = (77 * rgba[..., 0] + 151 * rgba[..., 1] + 28 * rgba[..., 2]).astype(numpy.int64) >> 8
+        if kind == Sketch.GRAY:
+            rgba[..., :3] = gray[..., None]
+        elif kind == Sketch.THRESHOLD:
+            level = 128 if param is None else int(param * 255)
+            rgba[..., :3] = numpy.where(gray >= level, 255, 0)[..., None]
+        elif kind == Sketch.ERODE:
+            # Replace each pixel by the darkest of itself and its four neighbours
+            padded = numpy.pad(gray, 1, mode="edge")
+            neighbours = numpy.stack([gray, padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]])
+            choice = numpy.argmin(neighbours, axis=0)
+            prgba = numpy.pad(rgba, ((1, 1), (1, 1), (0, 0)), mode="edge")
+            candidates = numpy.stack([rgba, prgba[:-2, 1:-1], prgba[2:, 1:-1], prgba[1:-1, :-2], prgba[1:-1, 2:]])
+            rgba = numpy.take_along_axis(candidates, choice[None, ..., None], axis=0)[0]
+        else:
+            raise ValueError("The raster backend does not support filter {}".format(kind))
+        self.pixels = pack(rgba).reshape(-1)
+
+    def save(self, filepath):
+        write_png(filepath, unpack(self.pixels).reshape(self.height, self.width, 4))
+
+
+class Graphics(Image):
+    '''An offscreen canvas, as returned by createGraphics().'''
+
+    def __init__(self, width, height):
+        Image.__init__(self, width, height)
+        self.matrix = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+        self.stack = []
+        self.fill_color = None
+        self.styles = []
+        self.clip_box = None
+
+    def beginDraw(self):
+        self.matrix = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+        self.stack = []
+        self.clip_box = None
+
+    def endDraw(self):
+        pass
+
+    def clear(self):
+        self.pixels = numpy.zeros(self.width * self.height, dtype=numpy.int32)
+
+    def background(self, *args):
+        self.pixels = numpy.full(self.width * self.height, color_value(*args) | -0x1000000, dtype=numpy.int32)
+
+    def fill(self, *args):
+        self.fill_color = color_value(*args)
+
+    def noFill(self):
+        self.fill_color = None
+
+    def noStroke(self):
+        pass # Strokes are not drawn
+
+    def pushStyle(self):
+        self.styles.append(self.fill_color)
+
+    def popStyle(self):
+        self.fill_color = self.styles.pop()
+
+    def clip(self, x, y, w, h):
+        '''Only draw inside the rectangle, in the current transform.'''
+        a, b, c, d, e, f = self.matrix
+        xs = [a * px + c * py + e for px, py in ((x, y), (x + w, y + h))]
+        ys = [b * px + d * py + f for px, py in ((x, y), (x + w, y + h))]
+        self.clip_box = (min(xs), min(ys), max(xs), max(ys))
+
+    def noClip(self):
+        self.clip_box = None
+
+    def pushMatrix(self):
+        self.stack.append(self.matrix)
+
+    def popMatrix(self):
+        self.matrix = self.stack.pop()
+
+    def translate(self, tx, ty):
+        a, b, c, d, e, f = self.matrix
+        self.matrix = (a, b, c, d, e + a * tx + c * ty, f + b * tx + d * ty)
+
+    def scale(self, sx, sy=None):
+        sy = sx if sy is None else sy
+        a, b, c, d, e, f = self.matrix
+        self.matrix = (a * sx, b * sx, c * sy, d * sy, e, f)
+
+    def rotate(self, angle):
+        cos_a, sin_a = math.cos(angle), math.sin(angle)
+        a, b, c, d, e, f = self.matrix
+        self.matrix = (a * cos_a + c * sin_a, b * cos_a + d * sin_a, c * cos_a - a * sin_a, d * cos_a - b * sin_a, e, f)
+
+    def rect(self, x, y, w, h):
+        if self.fill_color is not None:
+            self.draw(Image(1, 1, [self.fill_color]), x, y, w, h)
+
+    def image(self, img, x, y, w=None, h=None):
+        '''Draw img into the rectangle (x, y, w, h) in the current
+        transform. Like Processing's Java2D renderer, this truncates
+        the corners of the rectangle to whole numbers first.'''
+        w = img.width if w is None else w
+        h = img.height if h is None else h
+        x1, y1 = int(x), int(y)
+        self.draw(img, x1, y1, int(x + w) - x1, int(y + h) - y1)
+
+    def draw(self, img, x, y, w, h):
+        '''Draw img into the rectangle (x, y, w, h) in the current
+        transform. Every target pixel whose centre falls inside the
+        rectangle samples the image bicubically, as Java2D does, and
+        is blended over by its alpha.'''
+        a, b, c, d, e, f = self.matrix
+        det = a * d - b * c
+        if w <= 0 or h <= 0 or not det:
+            return
+        corners = [(a * px + c * py + e, b * px + d * py + f) for px, py in ((x, y), (x + w, y), (x, y + h), (x + w, y + h))]
+        left = max(0, int(math.floor(min(p[0] for p in corners))))
+        right = min(self.width, int(math.ceil(max(p[0] for p in corners))))
+        top = max(0, int(math.floor(min(p[1] for p in corners))))
+        bottom = min(self.height, int(math.ceil(max(p[1] for p in corners))))
+        if self.clip_box is not None:
+            left = max(left, int(math.ceil(self.clip_box[0] - 0.5)))
+            top = max(top, int(math.ceil(self.clip_box[1] - 0.5)))
+            right = min(right, int(math.ceil(self.clip_box[2] - 0.5)))
+            bottom = min(bottom, int(math.ceil(self.clip_box[3] - 0.5)))
+        if left >= right or top >= bottom:
+            return
+        # Map the target pixel centres back into the rectangle
+        ty, tx = numpy.mgrid[top:bottom, left:right]
+        cx, cy = tx + 0.5 - e, ty + 0.5 - f
+        # Round off the error of inverting the transform, so that a centre on the edge between two images is in one only
+        lx = numpy.round((d * cx - c * cy) / det, 9)
+        ly = numpy.round((a * cy - b * cx) / det, 9)
+        inside = (lx >= x) & (lx < x + w) & (ly >= y) & (ly < y + h)
+        if not inside.any():
+            return
+        src = img.premultiplied()
+        u = (lx - x) * (img.width / float(w)) - 0.5
+        v = (ly - y) * (img.height / float(h)) - 0.5
+        u0, v0 = numpy.floor(u), numpy.floor(v)
+        fu, fv = u - u0, v - v0
+        u0 = u0.astype(numpy.int64)
+        v0 = v0.astype(numpy.int64)
+        sample = 0.0
+        for j, wv in zip(range(-1, 3), cubic_weights(fv)):
+            row = numpy.clip(v0 + j, 0, img.height - 1)
+            for i, wu in zip(range(-1, 3), cubic_weights(fu)):
+                sample = sample + src[row, numpy.clip(u0 + i, 0, img.width - 1)] * (wu * wv)[..., None]
+        sample = numpy.clip(sample, 0.0, 255.0)
+        sample[..., :3] = numpy.minimum(sample[..., :3], sample[..., 3:])
+        rgba = self.premultiplied()
+        target = rgba[top:bottom, left:right]
+        blended = sample + target * (1.0 - sample[..., 3:] / 255.0)
+        rgba[top:bottom, left:right] = numpy.where(inside[..., None], blended, target)
+        self.set_premultiplied(rgba)
+
+
+class Sketch(Graphics):
+    '''Stands in for the Processing sketch: a canvas of the window
+    size plus the image factories, colour accessors and data folder
+    that the modules ask the sketch for.'''
+    RGB = 1
+    ARGB = 2
+    GRAY = 12
+    THRESHOLD = 16
+    ERODE = 17
+
+    def __init__(self, width, height, data_path):
+        Graphics.__init__(self, width, height)
+        self.data_path = data_path
+
+    def dataPath(self, subfolder):
+        return os.path.join(self.data_path, subfolder)
+
+    def sketchPath(self):
+        return os.path.dirname(os.path.abspath(self.data_path))
+
+    def createGraphics(self, w, h):
+        return Graphics(w, h)
+
+    def createImage(self, w, h, mode):
+        return Image(w, h)
+
+    def loadImage(self, filepath):
+        if not filepath.lower().endswith(".png"):
+            print("The raster backend can only load PNG files, skipping <{}>".format(filepath))
+            return None
+        rgba = read_png(filepath)
+        return Image(rgba.shape[1], rgba.shape[0], pack(rgba).reshape(-1))
+
+    def alpha(self, p):
+        return float(p >> 24 & 0xFF)
+
+    def red(self, p):
+        return float(p >> 16 & 0xFF)
+
+    def green(self, p):
+        return float(p >> 8 & 0xFF)
+
+    def blue(self, p):
+        return float(p & 0xFF)
+
+    def brightness(self, p):
+        return float(max(p >> 16 & 0xFF, p >> 8 & 0xFF, p & 0xFF))
+
+    def hue(self, p):
+        return colorsys.rgb_to_hsv((p >> 16 & 0xFF) / 255.0, (p >> 8 & 0xFF) / 255.0, (p & 0xFF) / 255.0)[0] * 255.0
+
+
+def color_value(*args):
+    '''Return the packed colour for the arguments of fill() or
+    background(): a gray level or packed colour, optionally with an
+    alpha, or red, green and blue, optionally with an alpha.'''
+    if len(args) > 2:
+        return color(*args)
+    value = int(args[0])
+    if 0 <= value <= 255:
+        value = color(value)
+    if len(args) == 2:
+        value = (value & 0xFFFFFF) | (int(args[1]) & 0xFF) << 24
+    return _signed(value & 0xFFFFFFFF)
+
+
+def cubic_weights(t):
+    '''Return the weights of the four pixels around a sample at
+    fraction t between the middle two, for Java2D's bicubic
+    interpolation (cubic convolution with a = -0.5).'''
+    def weight(d):
+        d = numpy.abs(d)
+        return numpy.where(d <= 1, (1.5 * d - 2.5) * d * d + 1, ((-0.5 * d + 2.5) * d - 4) * d + 2)
+    return [weight(t + 1), weight(t), weight(1 - t), weight(2 - t)]
+
+
+def resampling_matrix(size, newsize):
+    '''Return the (newsize, size) matrix that resamples a row of
+    pixels as Processing's resize() does: halving the size with
+    bilinear interpolation until the next halving would pass
+    newsize, then interpolating to newsize.'''
+    m = numpy.identity(size)
+    while size != newsize:
+        step = max(size / 2, newsize) if size > newsize else newsize
+        m = bilinear_matrix(size, step).dot(m)
+        size = step
+    return m
+
+
+def bilinear_matrix(size, newsize):
+    '''Return the (newsize, size) matrix that interpolates linearly
+    between pixel centres, repeating the pixels at the edges.'''
+    m = numpy.zeros((newsize, size))
+    scale = size / float(newsize)
+    for i in range(newsize):
+        pos = min(max((i + 0.5) * scale - 0.5, 0), size - 1)
+        j = int(math.floor(pos))
+        frac = pos - j
+        m[i, j] += 1 - frac
+        if frac:
+            m[i, j + 1] += frac
+    return m
+
+
+#####################################################################
+# PNG files
+#####################################################################
+
+def write_png(filepath, rgba):
+    '''Write float RGBA channels of shape (height, width, 4) as an 8-bit RGBA PNG.'''
+    h, w = rgba.shape[:2]
+    data = numpy.clip(numpy.rint(rgba), 0, 255).astype(numpy.uint8)
+    raw = b"".join(b"\x00" + data[y].tobytes() for y in range(h)) # Filter type 0 on every row
+    def chunk(kind, body):
+        return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body) & 0xFFFFFFFF)
+    folder = os.path.dirname(filepath)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    f = open(filepath, "wb")
+    f.write(b"\x89PNG\r\n\x1a\n")
+    f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 6, 0, 0, 0)))
+    f.write(chunk(b"IDAT", zlib.compress(raw, 6)))
+    f.write(chunk(b"IEND", b""))
+    f.close()
+
+
+def read_png(filepath):
+    '''Read an 8-bit, non-interlaced PNG file and return its float
+    RGBA channels, of shape (height, width, 4).'''
+    f = open(filepath, "rb")
+    data = f.read()
+    f.close()
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        raise ValueError("<{}> is not a PNG file".format(filepath))
+    pos = 8
+    idat = []
+    palette = transparency = None
+    while pos < len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if kind == b"IHDR":
+            w, h, depth, colortype, _, _, interlace = struct.unpack(">IIBBBBB", body)
+        elif kind == b"PLTE":
+            palette = numpy.frombuffer(body, dtype=numpy.uint8).reshape(-1, 3)
+        elif kind == b"tRNS":
+            transparency = numpy.frombuffer(body, dtype=numpy.uint8)
+        elif kind == b"IDAT":
+            idat.append(body)
+        elif kind == b"IEND":
+            break
+    if depth != 8 or interlace:
+        raise ValueError("The raster backend can only read 8-bit, non-interlaced PNG files: <{}>".format(filepath))
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[colortype]
+    raw = numpy.frombuffer(zlib.decompress(b"".join(idat)), dtype=numpy.uint8).reshape(h, w * channels + 1)
+    pixels = unfilter(raw, channels).reshape(h, w, channels).astype(numpy.float64)
+    opaque = numpy.full((h, w, 1), 255.0)
+    if colortype == 0:
+        return numpy.concatenate([pixels, pixels, pixels, opaque], axis=-1)
+    if colortype == 2:
+        return numpy.concatenate([pixels, opaque], axis=-1)
+    if colortype == 3:
+        alphas = numpy.full(len(palette), 255, dtype=numpy.uint8)
+        if transparency is not None:
+            alphas[:len(transparency)] = transparency
+        table = numpy.concatenate([palette, alphas[:, None]], axis=-1).astype(numpy.float64)
+        return table[pixels[..., 0].astype(numpy.int64)]
+    if colortype == 4:
+        return numpy.concatenate([pixels[..., :1]] * 3 + [pixels[..., 1:]], axis=-1)
+    return pixels
+
+
+def unfilter(raw, bpp):
+    '''Undo the PNG filter of each row. Sub, Average and Paeth depend
+    on the byte to the left, so they are undone a pixel at a time.'''
+    rows = numpy.zeros((raw.shape[0], raw.shape[1] - 1), dtype=numpy.int64)
+    prev = numpy.zeros(raw.shape[1] - 1, dtype=numpy.int64)
+    for y in range(raw.shape[0]):
+        kind = raw[y, 0]
+        row = raw[y, 1:].astype(numpy.int64)
+        if kind == 1:
+            row = numpy.cumsum(row.reshape(-1, bpp), axis=0).reshape(-1) % 256
+        elif kind == 2:
+            row = (row + prev) % 256
+        elif kind in (3, 4):
+            out = row.tolist()
+            above = prev.tolist()
+            for i in range(len(out)):
+                left = out[i - bpp] if i >= bpp else 0
+                if kind == 3:
+                    out[i] = (out[i] + (left + above[i]) // 2) % 256
+                else:
+                    upleft = above[i - bpp] if i >= bpp else 0
+                    p = left + above[i] - upleft
+                    pa, pb, pc = abs(p - left), abs(p - above[i]), abs(p - upleft)
+                    predictor = left if pa <= pb and pa <= pc else (above[i] if pb <= pc else upleft)
+                    out[i] = (out[i] + predictor) % 256
+            row = numpy.array(out, dtype=numpy.int64)
+        rows[y] = row
+        prev = row
+    return rows.astype(numpy.uint8)
+
+
+#####################################################################
+# Validation against Processing
+#####################################################################
+
+def record_reference(sketch, drawing, filepath, count=8, seed=1):
+    '''Render count seeded random genomes with Processing, at window
+    size and at the size of every comparator strictness level, and
+    save them with the drawing settings for validate(). The sketch
+    calls it when app.record_raster_reference is set.
+
+    Rotation jitter is seeded by the hash of the genome, which
+    differs between Jython and CPython 2.7, so record with it disabled.
+    '''
+    import random
+    import utils
+    import image_comparator as ic
+    rng = random.Random(seed)
+    sizes = [(sketch.width, sketch.height)] + [ic.evaluation_size(sketch.width, sketch.height, s) for s in range(1, len(ic.comparison_sizes) + 1)]
+    cases = []
+    for i in range(count):
+        genes = [rng.random() for g in range(drawing.num_params())]
+        for w, h in sizes:
+            img = drawing.render_offscreen(sketch, genes, w, h)
+            img.loadPixels()
+            cases.append((genes, w, h, [int(p) for p in img.pixels]))
+    settings = dict((attr, getattr(drawing, attr)) for attr in dir(drawing) if attr.startswith("config_"))
+    utils.save_object(filepath, {"settings": settings, "cases": cases})
+    print("Saved {} reference drawings to <{}>.".format(len(cases), filepath))
+
+
+def validate(filepath, data_path=None):
+    '''Render the drawings saved by record_reference() with the raster
+    backend and compare them with Processing's. Return True if they
+    all match within config_validation_tolerance.'''
+    import utils
+    import drawing
+    reference = utils.load_object(filepath)
+    for attr, value in reference["settings"].items():
+        setattr(drawing, attr, value)
+    if drawing.config_rotation_jitter:
+        print("WARNING: rotation jitter is enabled so the drawings cannot match.")
+    drawing.initialize()
+    genes, width, height, pixels = reference["cases"][0]
+    sketch = Sketch(width, height, data_path or os.path.dirname(os.path.abspath(filepath)))
+    passed = True
+    print("{:>9} {:>10} {:>10} {:>9}".format("size", "mean diff", "max diff", "mismatch"))
+    for genes, w, h, pixels in reference["cases"]:
+        expected = unpack(pixels)
+        actual = unpack(drawing.render_offscreen(sketch, genes, w, h).pixels)
+        diff = numpy.abs(expected - actual).max(axis=-1)
+        mismatch = numpy.mean(diff > config_validation_tolerance)
+        ok = mismatch <= config_validation_max_mismatch
+        passed = passed and ok
+        print("{:>9} {:>10.2f} {:>10.0f} {:>8.2%}{}".format("{}x{}".format(w, h), diff.mean(), diff.max(), mismatch, "" if ok else "  FAIL"))
+    print("The raster backend {} Processing.".format("matches" if passed else "does NOT match"))
+    return passed
+
+
+if __name__ == "__main__":
+    # python2.7 raster.py data/raster_reference.pkl [data folder]
+    args = sys.argv[1:]
+    sys.exit(0 if validate(args[0], args[1] if len(args) > 1 else None) else 1)
@@ -5,6 +5,7 @@ app = Settings()
 drawing = Settings()
 ga = Settings()
 ic = Settings()
+islands = Settings()
 
 #### DON'T CHANGE ANYTHING ABOVE THIS LINE ####
 
@@ -14,6 +15,11 @@ app.testmode = False
 app.autosave_fittest_only = True
 app.data_folder_name = None
 app.regulate_frame_rate = True
+app.headless = False
+app.frame_time_budget = None
+app.checkpoint_interval = 25
+app.resume_run = None
+app.profile = False
 
 # Optional override of default width and height of 400 x 400 for sketch window
 # width = 500
@@ -35,6 +41,7 @@ drawing.config_sort_parts_by_filename = False
 ic.config_strictness = 4
 ic.config_preprocess_mode = "gray"
 ga.max_stagnant_generations = 500
+islands.config_island_count = 1
 
 
 '''
@@ -58,6 +65,33 @@ Set to True to save a high-res image of only the fittest scheme (generally, leav
 app.data_folder_name
 Optional. Set to the name of a folder in [sketch]/data to organize your sketch into subprojects
 
+app.headless
+Set to True to run the solver to completion without drawing anything, e.g. for overnight runs.
+Results are saved to the run folder as usual and the throughput is printed and saved to throughput.txt.
+The sketch still opens its window, so it needs a display, and it quits when the search is finished.
+On a server without a display, run "python2.7 batch.py" from the sketch folder instead. That runs the
+same search on the NumPy raster backend (CPython 2.7 with NumPy), without Processing. It uses these
+settings but not fitness.py.
+
+app.frame_time_budget
+Optional. Seconds to spend evolving generations in each frame. Leave at None to evolve one generation per frame.
+
+app.checkpoint_interval
+Generations between snapshots of the solver saved to checkpoint.pkl in the run folder. Set to 0 to disable.
+
+app.resume_run
+Optional. Set to a run number (e.g. 12) or "last" to carry on with an interrupted run from its last checkpoint
+instead of starting a new run. Outputs continue to be saved to the same run folder. Remember to set it back to None.
+
+app.record_raster_reference
+Optional. Set to True to render a few seeded drawings, save them to raster_reference.pkl in the data folder and quit,
+instead of running the solver. Run "python2.7 raster.py data/raster_reference.pkl" afterwards to check the NumPy
+raster backend against them. Disable drawing.config_rotation_jitter while recording.
+
+app.profile
+Set to True to time each phase of every generation (selection, rendering, grabbing the canvas,
+preprocessing, comparing and autosaving) and append the results to timings.csv in the run folder.
+
 drawing.config_layout
 Specifies the layout to use ("GridLayout" or "PointLayout")
 
@@ -90,6 +124,15 @@ Degrees of random rotation for each part after it is placed. Set to 0 to disable
 drawing.config_crop_to_cell
 Set to True to crop parts to grid cells or False to allow parts to overflow grid cell boundaries
 
+drawing.config_cell_fitness_tables
+Optional. Applies to grid layout with drawing.config_crop_to_cell set to True. If included and set to True then 
+drawings are scored by adding up the remembered scores of what is in each of their cells instead of being rendered,
+which is much faster once the common combinations of cell, part and angle have been seen. Scale and nudge values
+that place a part on the same whole pixels at the comparator resolution share a combination, so the tables still pay
+off with scaling and nudging enabled, though less so at high strictness. The scores are the same as rendering the
+drawing (measured against Processing's renderer: no difference). Not used with rotation jitter, a background module
+or eroded binary comparators.
+
 drawing.config_nudge_factor_max
 A multiple of the grid cell dimension. Set to 0 to disable nudge and keep parts in center of cells.
 
@@ -99,6 +142,32 @@ Set to True to override the default draw order of parts, which draws largest ima
 drawing.config_render_grid
 Applies to grid layout only. Optional. If included and set to True then the grid will be drawn before parts are rendered.
 
+drawing.config_atlas_rendering
+Optional. If included and set to True then all of the drawings evaluated together are rendered as tiles of one
+large offscreen buffer, which saves setting up a buffer and reading its pixels back for each drawing. Ignored
+when a custom fitness function is used.
+
+drawing.config_incremental_rendering
+Optional. If included and set to True then each child is drawn by copying the drawing of the parent it takes most of
+its genes from and drawing again only the areas where its parts differ, and only the pixels in those areas are compared
+again. Children that differ from their parent over more than half of the canvas are drawn in full. Ignored when a
+custom fitness function or cell fitness tables are used, and not used with rotation jitter, a background module or
+eroded binary comparators. Note that it turns off the early stopping of ga.config_selection = "tournament": every drawing
+is compared in full so that its evaluation can be reused for its children.
+
+drawing.config_parts_cache
+Optional. Defaults to True, which remembers the size of each part and its pre-scaled copies in the cache folder
+of the data folder, so that only new or changed parts are analysed when the sketch starts. Unchanged parts start
+from their cached copies and are only loaded at full size when the hi-res images need them, within
+drawing.config_parts_memory_bytes. Delete the cache folder to rebuild it, or set to False to analyse every part on
+every start.
+
+drawing.config_lazy_parts
+Optional. Set to True for very large parts libraries that do not fit in memory. Only the pre-scaled copies of parts
+no larger than drawing.config_part_proxy_size are kept in memory, which is all that the comparator needs. The larger
+copies are loaded from the parts cache when the preview or hi-res images are drawn, and the least recently used ones
+are dropped once they take up more than drawing.config_parts_memory_bytes.
+
 ic.config_strictness
 1-7, with 7 being the most accurate representation of the comparator image. Use only the highest value you need. 
 Start with 4, then try 5. Values of 6 or 7 will be more accurate but very slow to compute.
@@ -108,7 +177,17 @@ ic.config_preprocess_mode
 If you select "color" then the values from the three RGB channels will be compared; if you select "hue" then
 only the color hue value will be compared, which will have the effect of ignoring brightness.
 
+ic.config_sample_cache
+Optional. Defaults to True, which keeps the preprocessed comparator samples in the cache folder of the data folder
+so that restarts with the same samples and settings skip preprocessing them. Delete the cache folder to clear it.
+
 ga.max_stagnant_generations
 Sets the maximum number of unchanged generations after which the solver will stop searching.
 
+islands.config_island_count
+Set to more than 1 to run an island model. Start the sketch that many times (e.g. with processing-java,
+ideally with app.headless = True) and each copy will evolve its own population, swapping its fittest
+genomes with the other copies every islands.config_migration_interval generations. All copies stop
+once every island has stagnated. Each copy saves its results to its own run folder.
+
 '''
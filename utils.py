@@ -8,8 +8,16 @@ import os
 import math
 import time
 import random
+import array
+import struct
+import threading
+import Queue
 from distutils.dir_util import copy_tree
 import shutil
+try:
+    import jarray # Only available under Jython
+except ImportError:
+    jarray = None
 try:
     import settings as config
 except:
@@ -17,8 +25,17 @@ except:
 
 
 def autosave(sketch, ga, drawing, fittestonly):
+    '''Queue a hi-res image of the fittest solution to be saved in
+    the background. If fittestonly is True, only the fittest
+    image is kept and exports it supersedes are skipped.'''
     if not ga.fitness_changed(): return
-    save_hi_res(sketch, ga, drawing, fittestonly)
+    AutosaveQueue(sketch, drawing).put(ga.fittest().genes, ga.generation_number(), fittestonly)
+
+
+def flush_autosave():
+    '''Wait until all queued hi-res images have been saved.'''
+    if AutosaveQueue._instance is not None:
+        AutosaveQueue._instance.flush()
     
     
 def save_low_res(sketch, ga):
@@ -40,21 +57,83 @@ def save_run_output_img(sketch, img, filename):
 
 def save_hi_res(sketch, ga, drawing, replace=False):
     '''Render and save a hi-res version of the fittest solution.'''
+    write_hi_res(sketch, drawing, ga.fittest().genes, ga.generation_number(), replace)
+    
+
+def write_hi_res(sketch, drawing, genes, generation, replace=False):
+    '''Render and save a hi-res version of a genome. If replace is
+    True, the images saved before it are deleted.'''
     runs = RunManager(sketch)
     create_folder(runs.run_dir_path)
     w = drawing.hi_res_width
     h = sketch.height * drawing.hi_res_width / sketch.width
     canvas = GraphicsBuffer(sketch.createGraphics, w, h)
     canvas.beginDraw()
-    drawing.render(sketch, ga.fittest().genes, canvas)
+    drawing.render(sketch, genes, canvas)
     canvas.endDraw()
-    filename = "generation-{0:04d}-hi-res.png".format(ga.generation_number())
+    filename = "generation-{0:04d}-hi-res.png".format(generation)
     outputdir = run_output_path(sketch)
-    if replace and os.path.isdir(outputdir):
-        delete_contents(outputdir)
     filepath = os.path.join(outputdir, filename)
     canvas.save(filepath)
-    #print("Saved hi-res image of fittest in generation {}".format(ga.generation_number()))
+    if replace:
+        # Delete the older images only once the new one is safely saved
+        for fn in listfiles(outputdir):
+            if fn != filename:
+                os.remove(os.path.join(outputdir, fn))
+    #print("Saved hi-res image of fittest in generation {}".format(generation))
+
+
+class AutosaveQueue(object):
+    """
+    Renders and saves hi-res images on a background thread so that
+    the solver does not wait for the PNG encoder. Images are saved
+    in the order they were queued. An export queued with replace
+    set supersedes any that are still waiting.
+    """
+    # Enforce a singleton pattern
+    _instance = None
+    def __new__(cls, sketch, drawing):
+        if cls._instance is None:
+            inst = super(AutosaveQueue, cls).__new__(cls)
+            inst.sketch = sketch
+            inst.drawing = drawing
+            inst.pending = []
+            inst.busy = False
+            inst.condition = threading.Condition()
+            thread = threading.Thread(target=inst._work, name="autosave")
+            thread.daemon = True
+            thread.start()
+            cls._instance = inst
+        return cls._instance
+    
+    def put(self, genes, generation, replace):
+        with self.condition:
+            if replace:
+                self.pending = [] # Only the newest fittest is worth saving
+            self.pending.append((genes, generation, replace))
+            self.condition.notify_all()
+            
+    def flush(self):
+        with self.condition:
+            while self.pending or self.busy:
+                self.condition.wait()
+            
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                genes, generation, replace = self.pending.pop(0)
+                self.busy = True
+            timer = profiler.start()
+            try:
+                write_hi_res(self.sketch, self.drawing, genes, generation, replace)
+            except Exception as e:
+                print("Could not save the hi-res image of generation {}: {}".format(generation, e))
+            profiler.stop("autosave", timer)
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
     
 
 def create_report(sketch, config, drawing, ga, ic):
@@ -118,6 +197,20 @@ def run_number(sketch):
     return RunManager(sketch).run_number
 
 
+def save_checkpoint(sketch, ga):
+    '''Save a snapshot of the solver to the run folder.'''
+    save_object(os.path.join(run_dir_path(sketch), "checkpoint.pkl"), ga.checkpoint())
+
+
+def load_checkpoint(sketch, resume_run):
+    '''Switch to an earlier run folder and return the last snapshot
+    of the solver that was saved in it.'''
+    filepath = os.path.join(RunManager(sketch, resume_run).run_dir_path, "checkpoint.pkl")
+    if not os.path.isfile(filepath):
+        raise ValueError("Cannot resume run {}: no checkpoint was saved in <{}>.".format(resume_run, filepath))
+    return load_object(filepath)
+
+
 def toggle_paused():
     global paused
     if not is_paused():
@@ -132,8 +225,10 @@ def is_paused():
     
 class RunManager(object):
     # Enforce a singleton pattern
+    # Pass resume_run the first time to continue an existing run
+    # (a run number or "last") instead of starting a new one.
     _instance = None
-    def __new__(cls, sketch):
+    def __new__(cls, sketch, resume_run=None):
         if cls._instance is None:
             inst = super(RunManager, cls).__new__(cls)
             inst.runs_base_path = app_data_path(sketch, "runs")
@@ -143,9 +238,24 @@ class RunManager(object):
                 pass
             runnumbers = sorted([int(fn.split("-")[1].lstrip("0")) for fn in listfiles(inst.runs_base_path)])
             prevrun = runnumbers[-1] if runnumbers else 0
+            if resume_run is not None:
+                inst.run_number = prevrun if resume_run == "last" else int(resume_run)
+                inst.run_dir_path = os.path.join(inst.runs_base_path, "run-{0:04d}".format(inst.run_number))
+                if not os.path.isdir(inst.run_dir_path):
+                    raise ValueError("Cannot resume run {}: <{}> does not exist.".format(resume_run, inst.run_dir_path))
+                cls._instance = inst
+                return inst
             inst.run_number = prevrun + 1
-            folder_name = "run-{0:04d}".format(inst.run_number)
-            inst.run_dir_path = os.path.join(inst.runs_base_path, folder_name)
+            while True:
+                # Claim the folder straight away so that copies of the sketch started together get their own runs
+                folder_name = "run-{0:04d}".format(inst.run_number)
+                inst.run_dir_path = os.path.join(inst.runs_base_path, folder_name)
+                try:
+                    os.mkdir(inst.run_dir_path)
+                    break
+                except OSError:
+                    if not os.path.isdir(inst.run_dir_path): raise
+                    inst.run_number += 1
             cls._instance = inst
         return cls._instance
 
@@ -225,17 +335,61 @@ def extract_pixel_values(pimg, samplesize, mode="gray", threshold=128, normalize
 
 class GraphicsBuffer(object):
     # Enforce a singleton pattern that allows only one instance
-    # per width+height pair to be created.
+    # per width+height pair to be created on each thread.
     _instances = {}
     def __new__(cls, createGraphics, canvas_width, canvas_height):
         w = int(math.ceil(canvas_width))
         h = int(math.ceil(canvas_height))
-        key = "{}_{}".format(w, h)
+        key = "{}_{}_{}".format(w, h, threading.current_thread().name)
         if key not in cls._instances:
             cls._instances[key] = createGraphics(w, h)
         return cls._instances[key]
 
 
+class WorkerPool(object):
+    """
+    A fixed set of named daemon threads that map a function over
+    a list of items in parallel. Results come back in the order of
+    the items, and the threads live as long as the pool so that
+    per-thread resources such as GraphicsBuffers are reused.
+
+    Usage:
+
+    pool = utils.WorkerPool(8)
+    results = pool.map(func, items)
+    """
+    
+    def __init__(self, size, name="worker"):
+        self.size = size
+        self.tasks = Queue.Queue()
+        for i in range(size):
+            thread = threading.Thread(target=self._work, name="{}-{}".format(name, i))
+            thread.daemon = True
+            thread.start()
+            
+    def _work(self):
+        while True:
+            func, items, results, i, done = self.tasks.get()
+            try:
+                results[i] = (True, func(items[i]))
+            except Exception as e:
+                results[i] = (False, e)
+            done.release()
+            
+    def map(self, func, items):
+        items = list(items)
+        results = [None] * len(items)
+        done = threading.Semaphore(0)
+        for i in range(len(items)):
+            self.tasks.put((func, items, results, i, done))
+        for i in range(len(items)):
+            done.acquire()
+        for ok, value in results:
+            if not ok:
+                raise value
+        return [value for ok, value in results]
+
+
 class FrameRateRegulator(object):
     """
     Automatically adjust the frame rate of a Processing sketch
@@ -291,6 +445,19 @@ class FrameRateRegulator(object):
 # Generic Python helpers
 #####################################################################
 
+def primitive_array(typecode, values):
+    '''Return the values as a compact array of primitives: a Java
+    array under Jython, or an array.array elsewhere. Typecodes are
+    the ones both accept, e.g. 'i' for int and 'd' for double.
+    '''
+    if jarray is not None:
+        return jarray.array(values, typecode)
+    return array.array(typecode, values)
+
+def to_float32(value):
+    '''Round a number to the nearest single-precision float, as Java does when passing a double to a float parameter.'''
+    return struct.unpack('f', struct.pack('f', value))[0]
+
 def coerce_list(obj):
     if type(obj) is list:
         return obj
@@ -390,10 +557,70 @@ class Timer(object):
         return time.time() - self.starttime
     def reset(self):
         self.starttime = time.time()
+
+
+class PhaseProfiler(object):
+    """
+    Times the phases of each generation and appends the count,
+    total and percentiles of each phase to a CSV file once per
+    generation. Does nothing unless enabled, so the calls can
+    stay in place at the cost of a single check.
+
+    Usage:
+
+    timer = utils.profiler.start()
+    render(...)
+    utils.profiler.stop("render", timer)
+    """
+    phases = ["select", "render", "grab", "preprocess", "compare", "autosave"]
+    percentiles = [50, 90, 99]
+    
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.samples = dict((phase, []) for phase in self.phases)
+        self.timer = Timer()
+        
+    def start(self):
+        return Timer() if self.enabled else None
         
+    def stop(self, phase, timer):
+        if timer is None: return
+        elapsed = timer.elapsed()
+        with self.lock: # Phases are timed on the worker threads too
+            self.samples[phase].append(elapsed)
             
-def jitter(val, max_amount):
-    return val + max_amount * (random.random() - 0.5)
+    def write_generation(self, filepath, generation):
+        '''Append a row for the generation to the CSV file and start
+        collecting the next one. Times are in milliseconds.'''
+        if not self.enabled: return
+        with self.lock:
+            samples = self.samples
+            self.samples = dict((phase, []) for phase in self.phases)
+        row = [generation, int(round(self.timer.elapsed() * 1000))]
+        self.timer.reset()
+        for phase in self.phases:
+            times = sorted(samples[phase])
+            row.extend([len(times), sum(times) * 1000])
+            row.extend([times[min(len(times) - 1, len(times) * p // 100)] * 1000 if times else 0 for p in self.percentiles])
+        lines = []
+        if not os.path.isfile(filepath):
+            header = ["generation", "generation_ms"]
+            for phase in self.phases:
+                header.extend(["{}_count".format(phase), "{}_total_ms".format(phase)])
+                header.extend(["{}_p{}_ms".format(phase, p) for p in self.percentiles])
+            lines.append(",".join(header))
+        lines.append(",".join("{:g}".format(round(v, 3)) for v in row))
+        f = open(filepath, "a")
+        f.write("\n".join(lines) + "\n")
+        f.close()
+
+profiler = PhaseProfiler()
+        
+            
+def jitter(val, max_amount, rng=None):
+    rng = rng or random
+    return val + max_amount * (rng.random() - 0.5)
     
 
 def euclidean_distance(x1, y1, x2, y2):
@@ -483,10 +710,40 @@ def create_folder(path):
         
 
 def save_object(path, obj):
+    '''Pickle obj to a temporary file and rename it over path, so
+    that another process never reads a half-written file.'''
     if not obj: return
-    f = open(path, 'wb')
-    pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    save_bytes(path, pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+    
+
+def save_bytes(path, data, attempts=5):
+    '''Write data to a temporary file and rename it over path.
+    
+    Windows will not rename over an existing file, so there the old
+    file is removed first. That is not atomic: for a moment there is
+    no file at path, and readers must treat a missing file as one not
+    written yet. Removing fails while another process has the file
+    open, so it is retried a few times.
+    '''
+    temppath = path + ".tmp"
+    f = open(temppath, 'wb')
+    f.write(data)
     f.close()
+    try:
+        os.rename(temppath, path)
+        return
+    except OSError:
+        pass
+    for attempt in range(attempts):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temppath, path)
+            return
+        except OSError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.1 * (attempt + 1))
     
 
 def load_object(path):